@@ -0,0 +1,777 @@
+#!/usr/bin/python
+
+'''Benchmarks for the coverage tools.
+
+Each benchmark works on synthetic data made by the generators below from a
+fixed random seed, so results only depend on the code being measured and the
+workload options, and can be compared across commits. Results are printed and
+optionally appended as JSON lines to a file, along with the git revision.
+
+The generators can also be used on their own with --generate DIR, which
+writes an lcov file, the matching source tree, gcno/gcda pairs and gcov
+output to DIR; scale the workload up to produce multi-GB inputs.'''
+
+import json
+import metrics
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = dict()
+def benchmark(name):
+    def ret_func(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return ret_func
+
+def mangled_name(fileno, funcno):
+    '''Returns a plausible mangled C++ function name. Every call returns a new
+    string object, as parsing an lcov file would.'''
+    return '_ZN7mozilla3dom%dNS_14Component%dInternal%dE%dEPKcRKNS_8nsString%dE' % (
+        len(str(fileno)) + 10, fileno, funcno, funcno % 7, fileno % 13)
+
+# Generators of synthetic input
+
+SEED = 20140301
+
+def source_path(fileno):
+    '''Returns the path of a synthetic source file relative to the source
+    tree, with about 20 files per directory.'''
+    return 'dom/component%d/sub%d/File%d.cpp' % (fileno // 400,
+        fileno // 20 % 20, fileno)
+
+def write_source_tree(basedir, files, lines):
+    '''Writes files source files of lines lines each under basedir.'''
+    for fileno in range(files):
+        path = os.path.join(basedir, source_path(fileno))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fd:
+            for line in range(1, lines + 1):
+                if line % 25 == 1:
+                    fd.write('void Component%d::Method%d(nsString& aName) {\n'
+                        % (fileno, line // 25))
+                else:
+                    fd.write('  if (mValue%d < %d && aName.Length() > 0) '
+                        'mValue%d++; // <%d>\n' % (line, fileno, line, line))
+
+def write_lcov(fd, basedir, files, lines, tests, branch_density):
+    '''Writes lcov data for the source tree written by write_source_tree to fd.
+    Each test covers about 70% of the files; 60% of the lines of a file are
+    executable, a function starts every 25 lines and branch_density of the
+    executable lines have two branches with two targets each.'''
+    rng = random.Random(SEED)
+    for testno in range(tests):
+        fd.write('TN:test%d\n' % testno)
+        for fileno in range(files):
+            if rng.random() >= 0.7:
+                continue
+            fd.write('SF:%s\n' % os.path.join(basedir, source_path(fileno)))
+            # Tests exercise a file to a varying degree.
+            hitrate = rng.random()
+            for line in range(1, lines + 1, 25):
+                fd.write('FN:%d,%s\n' % (line, mangled_name(fileno, line)))
+                fd.write('FNDA:%d,%s\n' % (rng.random() < hitrate and
+                    rng.randint(1, 1000) or 0, mangled_name(fileno, line)))
+            branches = []
+            for line in range(1, lines + 1):
+                if line % 5 >= 3 and line % 25 != 1:
+                    continue
+                count = rng.random() < hitrate and rng.randint(1, 5000) or 0
+                fd.write('DA:%d,%d\n' % (line, count))
+                if rng.random() < branch_density:
+                    taken = rng.randint(0, count)
+                    for block in range(2):
+                        for target, value in enumerate((taken, count - taken)):
+                            branches.append('BRDA:%d,%d,%d,%s\n' % (line, block,
+                                target, value if count else '-'))
+            fd.writelines(branches)
+            fd.write('end_of_record\n')
+
+def _gcov_record(tag, words):
+    return struct.pack('=II', tag, len(words)) + struct.pack(
+        '=%dI' % len(words), *words)
+
+def _gcov_string(text):
+    # Strings are NUL-terminated and padded to a multiple of 4 bytes.
+    padded = text + '\0' * (4 - len(text) % 4)
+    return [len(padded) // 4] + list(struct.unpack('=%dI' % (len(padded) // 4),
+        padded))
+
+def _gcov_header(magic, version='408*', stamp='BNCH'):
+    value = lambda s: sum(ord(c) << shift for c, shift in zip(s, [24, 16, 8, 0]))
+    return struct.pack('=III', magic, value(version), value(stamp))
+
+def write_gcno_gcda(gcnofile, gcdafile, sourcefile, functions, diamonds):
+    '''Writes a gcno/gcda pair of functions functions, each a chain of diamonds
+    if-else diamonds, one in four of which is a loop. Only one arc of each
+    branch has a counter; gcov has to solve the rest from the flow.'''
+    rng = random.Random(SEED)
+    notes = [_gcov_header(0x67636e6f)]
+    counts = [_gcov_header(0x67636461)]
+    line = 1
+    for ident in range(1, functions + 1):
+        # Blocks are the entry block 0, then (head, left, right) for every
+        # diamond, then the exit block. Each head is the join of the previous
+        # diamond. arcs is a list per block of (target, computed, count).
+        nblocks = 3 * diamonds + 2
+        arcs = [[] for _ in range(nblocks)]
+        calls = rng.randint(1, 100)
+        arcs[0].append((1, False, calls))
+        incoming = calls
+        for d in range(diamonds):
+            head, left, right = 3 * d + 1, 3 * d + 2, 3 * d + 3
+            join = head + 3 if d < diamonds - 1 else nblocks - 1
+            back = rng.randint(0, 3 * incoming) if d % 4 == 3 else 0
+            total = incoming + back
+            taken = rng.randint(back, total)
+            arcs[head].append((left, False, taken))
+            arcs[head].append((right, True, total - taken))
+            if back:
+                arcs[left].append((head, False, back))
+            arcs[left].append((join, True, taken - back))
+            arcs[right].append((join, True, total - taken))
+        checksums = [ident * 7919, ident * 104729]
+        name = 'Function%d' % ident
+        notes.append(_gcov_record(0x01000000, [ident] + checksums +
+            _gcov_string(name) + _gcov_string(sourcefile) + [line]))
+        notes.append(_gcov_record(0x01410000, [0] * nblocks))
+        for block in range(nblocks):
+            if arcs[block]:
+                notes.append(_gcov_record(0x01430000, [block] + sum(
+                    ([target, computed and 1 or 0]
+                    for target, computed, _ in arcs[block]), [])))
+        for block in range(1, nblocks - 1):
+            notes.append(_gcov_record(0x01450000, [block, 0] +
+                _gcov_string(sourcefile) + [line + block // 3 + 1, 0, 0]))
+        line += diamonds + 2
+        counters = []
+        for block in range(nblocks):
+            for _, computed, count in arcs[block]:
+                if not computed:
+                    counters.extend([count & 0xffffffff, count >> 32])
+        counts.append(_gcov_record(0x01000000, [ident] + checksums))
+        counts.append(_gcov_record(0x01a10000, counters))
+    with open(gcnofile, 'wb') as fd:
+        fd.write(''.join(notes))
+    with open(gcdafile, 'wb') as fd:
+        fd.write(''.join(counts))
+
+def write_gcov(fd, sourcefile, lines, branch_density):
+    '''Writes the output of gcov -b -c -a -f for a source file of lines lines,
+    with a function every 25 lines.'''
+    rng = random.Random(SEED)
+    fd.write('        -:    0:Source:%s\n' % sourcefile)
+    fd.write('        -:    0:Runs:1\n')
+    for line in range(1, lines + 1):
+        if line % 25 == 1:
+            count = rng.randint(0, 100)
+            fd.write('function Method%d called %d returned 100%% blocks '
+                'executed 80%%\n' % (line // 25, count))
+        if line % 5 >= 3 and line % 25 != 1:
+            fd.write('        -:%5d:  mValue%d++;\n' % (line, line))
+            continue
+        count = rng.randint(0, 3) and rng.randint(1, 5000)
+        fd.write('%9s:%5d:  if (mValue%d) mValue%d++;\n' % (
+            count or '#####', line, line, line))
+        fd.write('%9s:%5d-block  0\n' % (count or '$$$$$', line))
+        if rng.random() < branch_density:
+            taken = rng.randint(0, count)
+            for branch, value in enumerate((taken, count - taken)):
+                if count:
+                    fd.write('branch %2d taken %d\n' % (branch, value))
+                else:
+                    fd.write('branch %2d never executed\n' % branch)
+
+def write_pccount(fd, basedir, files, lines, tests):
+    '''Writes a pccount dump, as read by pcc-js-coverage.js, for the source
+    tree written by write_source_tree to fd: a line per test, running about
+    70% of the files. Each file is a top-level script plus a function every 25
+    lines, with two or three opcodes per executable line.'''
+    rng = random.Random(SEED)
+    for testno in range(tests):
+        scripts = [basedir]
+        for fileno in range(files):
+            if rng.random() >= 0.7:
+                continue
+            filename = 'file://' + os.path.join(basedir, source_path(fileno))
+            hitrate = rng.random()
+            for start in range(1, lines + 1, 25):
+                opcodes = []
+                total = 0
+                for line in range(start, min(start + 25, lines + 1)):
+                    if line % 5 >= 3 and line % 25 != 1:
+                        continue
+                    count = rng.random() < hitrate and rng.randint(1, 5000) or 0
+                    for _ in range(rng.randint(2, 3)):
+                        opcodes.append({'line': line, 'text': '',
+                            'counts': {'interp': count}})
+                    total += count
+                scripts.append([{'file': filename, 'line': start,
+                    'name': 'Method%d_%d' % (fileno, start // 25),
+                    'totals': {'interp': total}},
+                    {'text': '', 'opcodes': opcodes}])
+        fd.write(json.dumps(scripts) + '\n')
+
+class Workload(object):
+    '''The sizes of the synthetic data. Generated files are written once to a
+    temporary directory and shared by all of the benchmarks of a run.'''
+    def __init__(self, scale=1.0, files=None, lines=400, tests=4,
+                 branch_density=0.1):
+        self.scale = scale
+        self.files = files if files is not None else max(1, int(1000 * scale))
+        self.lines = lines
+        self.tests = tests
+        self.branch_density = branch_density
+        self._tmpdir = None
+        self._lcovfile = None
+        self._coverage = None
+
+    def describe(self):
+        return {'scale': self.scale, 'files': self.files, 'lines': self.lines,
+                'tests': self.tests, 'branch-density': self.branch_density}
+
+    def tmpdir(self):
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.mkdtemp('ccovbench')
+        return self._tmpdir
+
+    def srcdir(self):
+        return os.path.join(self.tmpdir(), 'src')
+
+    def lcovfile(self):
+        '''Returns an lcov file of the workload, along with its source tree.'''
+        if self._lcovfile is None:
+            write_source_tree(self.srcdir(), self.files, self.lines)
+            self._lcovfile = os.path.join(self.tmpdir(), 'coverage.info')
+            with open(self._lcovfile, 'w') as fd:
+                write_lcov(fd, self.srcdir(), self.files, self.lines,
+                    self.tests, self.branch_density)
+        return self._lcovfile
+
+    def coverage(self):
+        '''Returns a CoverageData of the lcov file of the workload.'''
+        from ccov import CoverageData
+        if self._coverage is None:
+            self._coverage = CoverageData()
+            self._coverage.addFromLcovFile(open(self.lcovfile(), 'r'))
+        return self._coverage
+
+    def cleanup(self):
+        self._coverage = None
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = self._lcovfile = None
+
+class NullWriter(object):
+    def write(self, data):
+        pass
+
+    def writelines(self, data):
+        for _ in data:
+            pass
+
+    def close(self):
+        pass
+
+def _function_memory(workload, add_function_hit):
+    from ccov import CoverageData
+    nfiles = int(20000 * workload.scale)
+    nfuncs, ntests = 50, 3
+    before = metrics.current_rss()
+    start = time.time()
+    coverage = CoverageData()
+    for test in range(ntests):
+        testname = 'test%d' % test
+        for fileno in range(nfiles):
+            filedata = coverage.get_or_add_file(
+                '/src/dom/component%d/File%d.cpp' % (fileno % 500, fileno),
+                testname)
+            for funcno in range(nfuncs):
+                name = mangled_name(fileno, funcno)
+                add_function_hit(filedata, name, 0, funcno * 10 + 1)
+                add_function_hit(filedata, name,
+                    (fileno + funcno + test) % 3)
+    elapsed = time.time() - start
+    used = metrics.current_rss() - before
+    functions = nfiles * nfuncs
+    return {'functions': functions, 'tests': ntests, 'seconds': elapsed,
+            'bytes': used, 'bytes-per-function-per-test':
+                float(used) / (functions * ntests)}
+
+@benchmark('function-memory')
+def bench_function_memory(workload):
+    '''Memory used by function data: 1M distinct functions (20000 files with
+    50 functions each at scale 1) recorded for 3 tests.'''
+    def add_function_hit(filedata, name, hitcount, lineno=None):
+        filedata.add_function_hit(name, hitcount, lineno)
+    return _function_memory(workload, add_function_hit)
+
+@benchmark('function-memory-baseline')
+def bench_function_memory_baseline(workload):
+    '''The function-memory benchmark with functions stored the way they were
+    before name interning, as a dict of name -> [line, count] per file. Run
+    it on its own, as memory freed by an earlier benchmark is reused.'''
+    functions = {}
+    def add_function_hit(filedata, name, hitcount, lineno=None):
+        funcs = functions.setdefault(filedata, {})
+        if not name in funcs:
+            funcs[name] = [lineno, 0]
+        fndata = funcs[name]
+        if lineno is not None:
+            fndata[0] = lineno
+        fndata[1] += hitcount
+    return _function_memory(workload, add_function_hit)
+
+@benchmark('branch-table')
+def bench_branch_table(workload):
+    '''Branch-heavy data: 500 files with 1000 branching lines of 2 branches
+    with 2 targets each at scale 1, for 3 tests. Times loading, merging the
+    tests, iterating over branches() and writing lcov output.'''
+    from ccov import CoverageData
+    nfiles = int(500 * workload.scale)
+    nlines, ntests = 1000, 3
+    result = {}
+    before = metrics.current_rss()
+    start = time.time()
+    coverage = CoverageData()
+    for test in range(ntests):
+        for fileno in range(nfiles):
+            filedata = coverage.get_or_add_file('/src/gen/Bindings%d.cpp' %
+                fileno, 'test%d' % test)
+            for line in range(1, nlines + 1):
+                for block in range(2):
+                    for target in range(2):
+                        filedata.add_branch_hit(line * 3, block, target,
+                            (line + block + target + test) % 3)
+    result['load-seconds'] = time.time() - start
+    result['bytes'] = metrics.current_rss() - before
+
+    start = time.time()
+    flat = coverage.getFlatData()
+    result['merge-seconds'] = time.time() - start
+
+    start = time.time()
+    for _ in range(3):
+        for filedata in flat.itervalues():
+            for _ in filedata.branches():
+                pass
+    result['iterate-seconds'] = time.time() - start
+
+    start = time.time()
+    writer = NullWriter()
+    for filedata in flat.itervalues():
+        filedata.write_lcov_output(writer)
+    result['write-seconds'] = time.time() - start
+    result['branches'] = nfiles * nlines * 4
+    return result
+
+@benchmark('lcov-load')
+def bench_lcov_load(workload):
+    '''CoverageData.addFromLcovFile on the workload's lcov file.'''
+    from ccov import CoverageData
+    lcovfile = workload.lcovfile()
+    size = os.path.getsize(lcovfile)
+    before = metrics.current_rss()
+    start = time.time()
+    coverage = CoverageData()
+    coverage.addFromLcovFile(open(lcovfile, 'r'))
+    elapsed = time.time() - start
+    return {'seconds': elapsed, 'input-bytes': size,
+            'bytes-per-second': size / elapsed,
+            'bytes': metrics.current_rss() - before}
+
+@benchmark('flat-merge')
+def bench_flat_merge(workload):
+    '''CoverageData._getFlatData over all tests of the workload.'''
+    coverage = workload.coverage()
+    start = time.time()
+    flat = coverage._getFlatData(coverage.getTests())
+    return {'seconds': time.time() - start, 'files': len(flat)}
+
+@benchmark('lcov-write')
+def bench_lcov_write(workload):
+    '''CoverageData.writeLcovOutput of the workload, to a null writer.'''
+    coverage = workload.coverage()
+    start = time.time()
+    coverage.writeLcovOutput(NullWriter())
+    return {'seconds': time.time() - start}
+
+@benchmark('hotspots')
+def bench_hotspots(workload):
+    '''hotspots.rank_hotspots over the data of the workload merged across
+    tests, keeping the 20 largest entries of each ranking.'''
+    import hotspots
+    coverage = workload.coverage()
+    files = coverage.getFlatData()
+    start = time.time()
+    report = hotspots.rank_hotspots(files, 20)
+    return {'seconds': time.time() - start, 'files': len(files),
+            'runs': len(report['runs'])}
+
+@benchmark('dedup')
+def bench_dedup(workload):
+    '''CoverageData.deduplicate on the workload's lcov file with the data of
+    test0 repeated for 8 more tests, as when tests run the same code the same
+    way, and the size of the file page data before and after.'''
+    from ccov import CoverageData
+    import make_ui
+    with open(workload.lcovfile(), 'r') as fd:
+        text = fd.read()
+    # The records of test0 run up to the TN: line of test1.
+    start = text.index('TN:test0\n') + len('TN:test0\n')
+    end = text.find('TN:', start)
+    records = text[start:end if end != -1 else len(text)]
+    lcovfile = os.path.join(workload.tmpdir(), 'dedup.info')
+    with open(lcovfile, 'w') as fd:
+        fd.write(text)
+        for clone in range(8):
+            fd.write('TN:clone%d\n' % clone)
+            fd.write(records)
+    coverage = CoverageData()
+    coverage.addFromLcovFile(open(lcovfile, 'r'))
+    builder = make_ui.UiBuilder(coverage, None, workload.srcdir())
+    builder.tests = ['all'] + sorted(coverage.getTests())
+    files = sorted(coverage.getFlatData())
+    page_bytes = lambda: sum(len(json.dumps(builder._buildFileData(file,
+        coverage.getFlatFileData(file)))) for file in files)
+    before = page_bytes()
+    start = time.time()
+    entries, distinct, saved = coverage.deduplicate()
+    elapsed = time.time() - start
+    result = {'seconds': elapsed, 'entries': entries, 'distinct': distinct,
+        'freed-bytes': saved, 'page-data-bytes-before': before,
+        'page-data-bytes-after': page_bytes()}
+    os.remove(lcovfile)
+    return result
+
+@benchmark('gcno-solve')
+def bench_gcno_solve(workload):
+    '''Reading a gcno/gcda pair with 40 functions of 250 diamonds each at scale
+    1 with GcnoData, then solving the arc counts of every function.'''
+    import gcov
+    functions = max(1, int(40 * workload.scale))
+    gcno = os.path.join(workload.tmpdir(), 'solve.gcno')
+    gcda = os.path.join(workload.tmpdir(), 'solve.gcda')
+    write_gcno_gcda(gcno, gcda, '/src/Solve.cpp', functions, 250)
+    start = time.time()
+    gcnodata = gcov.GcnoData()
+    gcnodata.read_gcno_file(gcno)
+    gcnodata.read_gcda_file(gcda)
+    result = {'read-seconds': time.time() - start}
+    start = time.time()
+    blocks = 0
+    for function in gcnodata._functions.itervalues():
+        graph = gcov.build_solver_graph(function)
+        gcov.solve_arc_counts(graph)
+        blocks += len(graph)
+    result['solve-seconds'] = time.time() - start
+    result['blocks'] = blocks
+    return result
+
+@benchmark('gcov-read')
+def bench_gcov_read(workload):
+    '''GcovLoader._readGcovFile on gcov output for 100 files at scale 1.'''
+    from ccov import GcovLoader
+    files = max(1, int(100 * workload.scale))
+    paths = []
+    for fileno in range(files):
+        path = os.path.join(workload.tmpdir(), 'File%d.cpp.gcov' % fileno)
+        with open(path, 'w') as fd:
+            write_gcov(fd, '/src/File%d.cpp' % fileno, workload.lines,
+                workload.branch_density)
+        paths.append(path)
+    size = sum(os.path.getsize(path) for path in paths)
+    loader = GcovLoader('/src', table={})
+    start = time.time()
+    for path in paths:
+        with open(path, 'r') as fd:
+            loader._readGcovFile(fd, '/src')
+    elapsed = time.time() - start
+    return {'seconds': elapsed, 'input-bytes': size,
+            'bytes-per-second': size / elapsed}
+
+@benchmark('pccount-load')
+def bench_pccount_load(workload):
+    '''CoverageData.loadPccountFile on a pccount dump of the workload, against
+    decoding every line of the dump as JSON, as the loader first did, and
+    against loading the lcov that pcc-js-coverage.js writes for it.'''
+    import ccov
+    pccfile = os.path.join(workload.tmpdir(), 'pccount.json')
+    if not os.path.isdir(workload.srcdir()):
+        workload.lcovfile()
+    with open(pccfile, 'w') as fd:
+        write_pccount(fd, workload.srcdir(), workload.files, workload.lines,
+            workload.tests)
+    size = os.path.getsize(pccfile)
+    start = time.time()
+    coverage = ccov.CoverageData()
+    coverage.loadPccountFile('', open(pccfile, 'r'))
+    elapsed = time.time() - start
+    start = time.time()
+    with open(pccfile, 'r') as fd:
+        ccov.CoverageData()._addPccountScripts('',
+            ccov.iter_pccount_scripts(fd, scan=False))
+    json_elapsed = time.time() - start
+    # The lcov text holds the same data in far fewer bytes, so this is the
+    # cost of the round trip on the Python side alone.
+    lcovfile = os.path.join(workload.tmpdir(), 'pccount.info')
+    with open(lcovfile, 'w') as fd:
+        coverage.writeLcovOutput(fd)
+    start = time.time()
+    ccov.CoverageData().addFromLcovFile(open(lcovfile, 'r'))
+    return {'seconds': elapsed, 'json-seconds': json_elapsed,
+            'lcov-seconds': time.time() - start, 'input-bytes': size,
+            'lcov-bytes': os.path.getsize(lcovfile),
+            'bytes-per-second': size / elapsed}
+
+@benchmark('ui-build')
+def bench_ui_build(workload):
+    '''UiBuilder output for the workload's lcov file and source tree, including
+    loading the data.'''
+    import make_ui
+    lcovfile = workload.lcovfile()
+    outdir = os.path.join(workload.tmpdir(), 'html')
+    # The builder prints a line for every page.
+    stdout = sys.stdout
+    sys.stdout = NullWriter()
+    try:
+        start = time.time()
+        make_ui.main(['make_ui.py', '-o', outdir, '-s', workload.srcdir(),
+            lcovfile])
+        elapsed = time.time() - start
+    finally:
+        sys.stdout = stdout
+    # What coverage.html loads up front: the whole tree (all.json, now only
+    # written with --tree-json) before, the top shard of the treemap now.
+    tree = make_ui.UiBuilder(workload.coverage(), None,
+        workload.srcdir())._loadGlobalData()
+    result = {'seconds': elapsed, 'files': workload.files,
+        'all-json-bytes': len(json.dumps(tree)),
+        'treemap-root-bytes': os.path.getsize(os.path.join(outdir,
+            'treemap.json'))}
+    shutil.rmtree(outdir, ignore_errors=True)
+    return result
+
+@benchmark('paged-file')
+def bench_paged_file(workload):
+    '''The page of a generated source file of 100000 lines at scale 1, written
+    whole and as chunks.'''
+    import make_ui
+    from ccov import CoverageData
+    lines = max(1, int(100000 * workload.scale))
+    srcdir = os.path.join(workload.tmpdir(), 'paged')
+    write_source_tree(srcdir, 1, lines)
+    lcovfile = os.path.join(workload.tmpdir(), 'paged.info')
+    with open(lcovfile, 'w') as fd:
+        write_lcov(fd, srcdir, 1, lines, workload.tests,
+            workload.branch_density)
+    coverage = CoverageData()
+    coverage.addFromLcovFile(open(lcovfile, 'r'))
+    result = {}
+    stdout = sys.stdout
+    sys.stdout = NullWriter()
+    try:
+        for kind, paged_lines in (('whole', 0), ('paged', 1)):
+            outdir = os.path.join(workload.tmpdir(), 'paged-' + kind)
+            builder = make_ui.UiBuilder(coverage, outdir, None,
+                paged_lines=paged_lines)
+            builder._loadGlobalData()
+            builder._loadTests()
+            dirname, filename = os.path.split(source_path(0))
+            with open(os.path.join(srcdir, source_path(0)), 'rb') as fd:
+                srcdata = fd.read()
+            start = time.time()
+            builder._makeFileData(dirname, filename, srcdata)
+            result[kind + '-seconds'] = time.time() - start
+            page = os.path.join(outdir, dirname, filename)
+            result[kind + '-page-bytes'] = os.path.getsize(page + '.html')
+            if paged_lines:
+                chunks = [os.path.join(page + '.chunks', name)
+                    for name in os.listdir(page + '.chunks')]
+                result['chunk-max-bytes'] = max(map(os.path.getsize, chunks))
+                result['chunks'] = len(chunks)
+    finally:
+        sys.stdout = stdout
+    return result
+
+def _latencies(url, paths):
+    import urllib2
+    latencies = []
+    for path in paths:
+        start = time.time()
+        urllib2.urlopen(url + path).read()
+        latencies.append(time.time() - start)
+    latencies.sort()
+    return latencies
+
+@benchmark('serve-latency')
+def bench_serve_latency(workload):
+    '''Latency of serve.py for the index, 20 directory pages and 100 file
+    pages, first on a cold page cache and then on a warm one.'''
+    import threading
+    import serve
+    coverage = workload.coverage()
+    start = time.time()
+    renderer = serve.make_renderer(coverage, workload.srcdir())
+    result = {'startup-seconds': time.time() - start}
+    server = serve.CoverageServer(('localhost', 0), renderer, quiet=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        dirs = sorted(renderer.directories)
+        files = [os.path.join(dirname, child['name'] + '.html')
+            for dirname in dirs
+            for child in renderer.directories[dirname]['files']
+            if not child['files']]
+        sampled = dirs[1::max(1, len(dirs) // 20)][:20]
+        paths = ['coverage.html', 'treemap.json', ''] + \
+            [dirname + '/' for dirname in sampled] + \
+            [dirname + '/treemap.json' for dirname in sampled] + \
+            files[::max(1, len(files) // 100)][:100]
+        url = 'http://localhost:%d/' % server.server_address[1]
+        for kind in ('cold', 'warm'):
+            latencies = _latencies(url, paths)
+            result[kind + '-median-seconds'] = latencies[len(latencies) // 2]
+            result[kind + '-max-seconds'] = latencies[-1]
+            result[kind + '-total-seconds'] = sum(latencies)
+        result['requests'] = len(paths)
+    finally:
+        server.shutdown()
+    return result
+
+@benchmark('sqlite-store')
+def bench_sqlite_store(workload):
+    '''Loading the workload into a covdb.py database, then querying it for
+    files under half covered and reading back the details of 100 files.'''
+    import covdb
+    coverage = workload.coverage()
+    dbfile = os.path.join(workload.tmpdir(), 'coverage.db')
+    if os.path.exists(dbfile):
+        os.remove(dbfile)
+    store = covdb.CoverageStore(dbfile)
+    start = time.time()
+    store.load(coverage)
+    result = {'load-seconds': time.time() - start,
+              'database-bytes': os.path.getsize(dbfile)}
+    start = time.time()
+    files = store.file_summaries(workload.srcdir(), 'test0', ('branches', 0.5))
+    result['query-seconds'] = time.time() - start
+    paths = [path for path, _ in store.file_summaries()]
+    start = time.time()
+    for path in paths[::max(1, len(paths) // 100)][:100]:
+        store.file_details(path)
+    result['details-seconds'] = time.time() - start
+    result['matching-files'] = len(files)
+    store.close()
+    return result
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def generate(workload, outdir):
+    '''Writes the synthetic data of the workload to outdir.'''
+    srcdir = os.path.join(os.path.abspath(outdir), 'src')
+    print >> sys.stderr, "Writing %d source files" % workload.files
+    write_source_tree(srcdir, workload.files, workload.lines)
+    print >> sys.stderr, "Writing coverage.info"
+    with open(os.path.join(outdir, 'coverage.info'), 'w') as fd:
+        write_lcov(fd, srcdir, workload.files, workload.lines, workload.tests,
+            workload.branch_density)
+    print >> sys.stderr, "Writing gcno/gcda and gcov files"
+    gcdadir = os.path.join(outdir, 'gcda')
+    if not os.path.isdir(gcdadir):
+        os.makedirs(gcdadir)
+    for fileno in range(max(1, workload.files // 100)):
+        source = os.path.join(srcdir, source_path(fileno))
+        base = os.path.join(gcdadir, 'File%d' % fileno)
+        write_gcno_gcda(base + '.gcno', base + '.gcda', source, 40, 250)
+        with open(base + '.cpp.gcov', 'w') as fd:
+            write_gcov(fd, source, workload.lines, workload.branch_density)
+    print >> sys.stderr, "Writing pccount.json"
+    with open(os.path.join(outdir, 'pccount.json'), 'w') as fd:
+        write_pccount(fd, srcdir, workload.files, workload.lines,
+            workload.tests)
+
+def main(argv):
+    from optparse import OptionParser
+    o = OptionParser(usage="%prog [options] [BENCHMARK...]\n"
+        "       %prog [options] --generate DIR")
+    o.add_option('-s', '--scale', dest="scale", type="float", default=1.0,
+        help="Multiply the size of the synthetic data by FACTOR",
+        metavar="FACTOR")
+    o.add_option('--files', dest="files", type="int",
+        help="Number of source files in the lcov data (default 1000 times "
+             "the scale)", metavar="N")
+    o.add_option('--lines', dest="lines", type="int", default=400,
+        help="Number of lines of each source file", metavar="N")
+    o.add_option('--tests', dest="tests", type="int", default=4,
+        help="Number of tests in the lcov data", metavar="N")
+    o.add_option('--branch-density', dest="branch_density", type="float",
+        default=0.1, help="Fraction of executable lines with branches",
+        metavar="FRACTION")
+    o.add_option('-r', '--repeat', dest="repeat", type="int", default=1,
+        help="Run each benchmark N times and report the best times and rates",
+        metavar="N")
+    o.add_option('-o', '--output', dest="outfile",
+        help="Append results as JSON lines to FILE", metavar="FILE")
+    o.add_option('-l', '--list', dest="list", action="store_true",
+        default=False, help="List the available benchmarks")
+    o.add_option('--generate', dest="generate_dir",
+        help="Write the synthetic data to DIR instead of running benchmarks",
+        metavar="DIR")
+    (opts, args) = o.parse_args(argv)
+    if opts.list:
+        for name in sorted(BENCHMARKS):
+            print '%s: %s' % (name, ' '.join(
+                BENCHMARKS[name].__doc__.split()))
+        return
+    workload = Workload(opts.scale, opts.files, opts.lines, opts.tests,
+        opts.branch_density)
+    if opts.generate_dir is not None:
+        generate(workload, opts.generate_dir)
+        return
+    names = args or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            o.error("Unknown benchmark %s" % name)
+
+    revision = git_revision()
+    outfd = open(opts.outfile, 'a') if opts.outfile is not None else None
+    try:
+        for name in names:
+            result = BENCHMARKS[name](workload)
+            for _ in range(opts.repeat - 1):
+                # Other values, such as memory usage, are kept from the first
+                # run, as later runs are skewed by the earlier ones.
+                for key, value in BENCHMARKS[name](workload).iteritems():
+                    if key.endswith('per-second'):
+                        result[key] = max(result[key], value)
+                    elif key.endswith('seconds'):
+                        result[key] = min(result[key], value)
+            print '%s: %s' % (name, ', '.join('%s=%s' % (key, result[key])
+                for key in sorted(result)))
+            result['benchmark'] = name
+            result['revision'] = revision
+            result['workload'] = workload.describe()
+            if outfd is not None:
+                outfd.write(json.dumps(result, sort_keys=True) + '\n')
+    finally:
+        workload.cleanup()
+        if outfd is not None:
+            outfd.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,74 +1,638 @@
 #!/usr/bin/python
 
 import array
+import bisect
+import collections
 import fnmatch
+import functools
+import hashlib
+import itertools
+import json
+import mmap
+import operator
 import re
 import shutil
 import subprocess
 import tempfile
+import metrics
 
-def format_set_difference(a, b):
-    if a == b:
-        return None
-    return "added %s\nremoved %s" % (str(b - a), str(a - b))
+def format_difference(difference):
+    '''Formats a difference tuple produced by FileCoverageDetails.differences
+    for display.'''
+    kind, key, ours, theirs = difference
+    return "Difference in %s %s: %s != %s" % (kind, key, ours, theirs)
+
+_lcovRecordRe = re.compile(r'^(TN|SF):(.*?)\r?$', re.M)
+
+def lcov_record_index(filename):
+    '''Returns a list of (test name, source file, offset) for every record in
+    the lcov file, where offset points just past the SF: line. The file is
+    scanned without parsing any of the records.'''
+    index = []
+    test = ''
+    with open(filename, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            return index
+        data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for match in _lcovRecordRe.finditer(data):
+                if match.group(1) == 'TN':
+                    test = match.group(2)
+                else:
+                    index.append((test, match.group(2), match.end() + 1))
+        finally:
+            data.close()
+    return index
+
+class NameTable(object):
+    '''Interns strings, such as function names, to small integer ids so that
+    each distinct string is only stored once however many files and tests
+    refer to it.'''
+
+    __slots__ = ('_ids', '_names')
+
+    def __init__(self):
+        self._ids = dict()
+        self._names = []
+
+    def intern(self, name):
+        '''Returns the id of name, adding it to the table if necessary.'''
+        nameid = self._ids.get(name)
+        if nameid is None:
+            nameid = len(self._names)
+            self._ids[name] = nameid
+            self._names.append(name)
+        return nameid
+
+    def name(self, nameid):
+        return self._names[nameid]
+
+    def __len__(self):
+        return len(self._names)
+
+class PathResolver(object):
+    '''Canonicalizes the source file paths found in coverage data, applying
+    prefix rewriting rules (such as objdir -> srcdir) and resolving symbolic
+    links. The same paths occur for every test and every function, so results
+    are cached to avoid repeating the stat calls, which are slow on network
+    filesystems.'''
+
+    # How much of a path's symbolic links to resolve: none, only the last
+    # component (as lcov paths are), or all components (as os.path.realpath).
+    KEEP_LINKS, RESOLVE_LINK, RESOLVE_ALL = range(3)
+
+    def __init__(self, rewrites=(), limit=1 << 16):
+        # List of (old prefix, new prefix); the first matching rule is used.
+        self.rewrites = list(rewrites)
+        self.limit = limit
+        # Map of [(path, basepath, mode) -> (resolved path, stat calls)]
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0
+
+    def add_rewrite(self, old, new):
+        self.rewrites.append((old, new))
+        self._cache.clear()
+
+    def resolve(self, path, basepath=None, mode=RESOLVE_LINK):
+        '''Returns the canonical form of path, which is relative to basepath
+        if basepath is given.'''
+        key = (path, basepath, mode)
+        entry = self._cache.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.saved += entry[1]
+            return entry[0]
+        self.misses += 1
+        resolved = path
+        if basepath is not None:
+            resolved = os.path.normpath(os.path.join(basepath, resolved))
+        for old, new in self.rewrites:
+            if resolved.startswith(old):
+                resolved = new + resolved[len(old):]
+                break
+        # realpath checks every component of the path with lstat.
+        components = resolved.count('/')
+        if mode == PathResolver.RESOLVE_ALL:
+            resolved, calls = os.path.realpath(resolved), components
+        elif mode == PathResolver.RESOLVE_LINK:
+            calls = 1
+            if os.path.islink(resolved):
+                resolved, calls = os.path.realpath(resolved), 1 + components
+        else:
+            calls = 0
+        # Clearing a full cache is cheaper per lookup than maintaining LRU
+        # order, and the working set is usually far smaller than the limit.
+        if len(self._cache) >= self.limit:
+            self._cache.clear()
+        self._cache[key] = (resolved, calls)
+        return resolved
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'lookups': lookups, 'hits': self.hits,
+                'hit-rate': float(self.hits) / lookups if lookups else 0.0,
+                'syscalls-saved': self.saved}
+
+    def report(self, fd):
+        stats = self.stats()
+        fd.write("Path cache: %d lookups, %.1f%% hits, %d stat calls saved\n" %
+            (stats['lookups'], 100 * stats['hit-rate'],
+            stats['syscalls-saved']))
+
+# Table used by FileCoverageDetails created outside of a CoverageData.
+_default_names = NameTable()
+
+# Block used to grow line arrays without building temporary lists.
+_MISSING_LINES = array.array('l', [-1])
+_is_line_present = functools.partial(operator.ne, -1)
+_branch_key = operator.itemgetter(0, 1, 2)
+_uncovered_run_re = re.compile('\x00+')
+
+# The opcodes arrays of a pccount dump hold most of its bytes. They are read
+# with regular expressions instead of being decoded: an opcodes array ends at
+# the first ] outside of a string, and as every " inside a string is escaped,
+# a "key": pattern can only match an actual key.
+_jsonStringPattern = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+_pccountArrayRe = re.compile(r'[^"\]]*(?:%s[^"\]]*)*' % _jsonStringPattern)
+_pccountLineRe = re.compile(r'"line":\s*(\d+)')
+_pccountCountsRe = re.compile(r'"counts":\s*\{([^}]*)\}')
+_pccountSingleCountRe = re.compile(r'"counts":\s*\{\s*"[^"]*":\s*(\d+)\s*\}')
+_pccountNumberRe = re.compile(r':\s*(\d+)')
+
+def _pccountOpcodes(body):
+    # Returns [(line, count)] for the opcodes of an array, or None if they
+    # cannot be paired up, in which case the array has to be decoded.
+    lines = _pccountLineRe.findall(body)
+    counts = _pccountSingleCountRe.findall(body)
+    if len(counts) == len(lines):
+        counts = map(int, counts)
+    else:
+        # Some opcodes have counts of several kinds.
+        number = _pccountNumberRe.findall
+        counts = [sum(map(int, number(count)))
+            for count in _pccountCountsRe.findall(body)]
+        if len(counts) != len(lines):
+            return None
+    return zip(map(int, lines), counts)
+
+def iter_pccount_scripts(fd, scan=True):
+    '''Yields (base path, summary, [(line, count)] or None) for every script
+    of every line of a pccount dump, where the list holds the line and total
+    count of each opcode of the script. Unless scan is False, the opcodes are
+    scanned for instead of decoding the whole line as JSON.'''
+    for line in fd:
+        if not line.strip():
+            continue
+        arrays = []
+        if scan:
+            pieces = []
+            pos = 0
+            while True:
+                key = line.find('"opcodes":', pos)
+                if key == -1:
+                    pieces.append(line[pos:])
+                    line = ''.join(pieces)
+                    break
+                start = line.find('[', key) + 1
+                end = line.find(']', start)
+                body = line[start:end]
+                if '\\' in body or body.count('"') % 2:
+                    # The first ] may be inside a string.
+                    end = _pccountArrayRe.match(line, start).end()
+                    body = line[start:end]
+                opcodes = None
+                if start and not line[key + 10:start - 1].strip():
+                    opcodes = _pccountOpcodes(body)
+                if opcodes is None:
+                    arrays = []
+                    break
+                arrays.append(opcodes)
+                pieces.append(line[pos:start])
+                pos = end
+        scripts = json.loads(line)
+        arrays.reverse()
+        for summary, contents in scripts[1:]:
+            opcodes = None
+            if contents is not None:
+                if arrays:
+                    opcodes = arrays.pop()
+                else:
+                    opcodes = [(opcode['line'],
+                        sum(opcode['counts'].itervalues()))
+                        for opcode in contents['opcodes']]
+            yield scripts[0], summary, opcodes
 
 class FileCoverageDetails(object):
     '''This class contains detailed information about the file, line, and branch
     coverage within a single file.'''
 
-    __slots__ = ('_lines', '_funcs', '_branches')
+    __slots__ = ('_lines', '_nlines', '_sparse_lines', '_sparse_counts',
+                 '_names', '_fnames', '_flines', '_fcounts', '_findex',
+                 '_brlines', '_brblocks', '_brtargets', '_brcounts',
+                 '_shared')
 
-    def __init__(self):
-        self._lines = array.array('l', [-1] * 1000)
-        self._funcs = dict()
-        self._branches = dict()
+    # Line data is stored densely in _lines, an array indexed by line number
+    # with -1 for lines without data, as long as it is at least SPARSE_DENSITY
+    # full or smaller than SPARSE_MIN_SIZE entries. Otherwise _lines is None and
+    # the data is stored sparsely in the parallel, sorted _sparse_lines and
+    # _sparse_counts arrays. Sparse data turns dense again once it reaches
+    # DENSE_DENSITY.
+    SPARSE_MIN_SIZE = 4096
+    SPARSE_DENSITY = 0.125
+    DENSE_DENSITY = 0.25
+
+    # Functions are stored in the parallel _fnames, _flines and _fcounts
+    # arrays, sorted by _fnames, holding the id of the function's name in the
+    # _names table, its line (-1 if unknown) and its hit count. Functions added
+    # out of order are appended, with _findex mapping name ids to their index,
+    # and the arrays are sorted again once the file is loaded or read.
+    #
+    # Branches are stored in the parallel _brlines, _brblocks, _brtargets and
+    # _brcounts arrays, sorted by (line, block, target).
+    #
+    # _shared is set when CoverageData.deduplicate made several (test, file)
+    # entries point to this instance, which is then copied before being
+    # modified.
+
+    def __init__(self, names=None):
+        self._lines = array.array('l')
+        self._nlines = 0
+        self._sparse_lines = None
+        self._sparse_counts = None
+        self._names = names if names is not None else _default_names
+        self._fnames = array.array('l')
+        self._flines = array.array('l')
+        self._fcounts = array.array('l')
+        self._findex = None
+        self._brlines = array.array('l')
+        self._brblocks = array.array('l')
+        self._brtargets = array.array('l')
+        self._brcounts = array.array('l')
+        self._shared = False
 
     def add_line_hit(self, line, hitcount):
         '''Note that the line has executed hitcount times.'''
-        if line >= len(self._lines):
-            self._lines.extend([-1] *
-                max(line + 1 - len(self._lines), len(self._lines)))
-        if self._lines[line] == -1:
-            self._lines[line] = hitcount
+        lines = self._lines
+        if lines is None:
+            self._add_sparse_line_hit(line, hitcount)
+            return
+        if line >= len(lines):
+            size = max(line + 1, 2 * len(lines), 64)
+            if size > self.SPARSE_MIN_SIZE and \
+                    self._nlines + 1 < size * self.SPARSE_DENSITY:
+                self._make_sparse()
+                self._add_sparse_line_hit(line, hitcount)
+                return
+            lines.extend(_MISSING_LINES * (size - len(lines)))
+        if lines[line] == -1:
+            lines[line] = hitcount
+            self._nlines += 1
+        else:
+            lines[line] += hitcount
+
+    def _add_sparse_line_hit(self, line, hitcount):
+        lines, counts = self._sparse_lines, self._sparse_counts
+        # Records are almost always in line order, so appending is the norm.
+        if not lines or line > lines[-1]:
+            lines.append(line)
+            counts.append(hitcount)
         else:
-            self._lines[line] += hitcount
+            i = bisect.bisect_left(lines, line)
+            if lines[i] == line:
+                counts[i] += hitcount
+                return
+            lines.insert(i, line)
+            counts.insert(i, hitcount)
+        if len(lines) >= (lines[-1] + 1) * self.DENSE_DENSITY:
+            self._make_dense()
+
+    def _make_sparse(self):
+        self._sparse_lines = array.array('l', (i for i, _ in self.lines()))
+        self._sparse_counts = array.array('l', (c for _, c in self.lines()))
+        self._lines = None
+
+    def _make_dense(self):
+        lines = _MISSING_LINES * (self._sparse_lines[-1] + 1)
+        for line, count in itertools.izip(self._sparse_lines,
+                self._sparse_counts):
+            lines[line] = count
+        self._lines = lines
+        self._nlines = len(self._sparse_lines)
+        self._sparse_lines = self._sparse_counts = None
+
+    def copy(self):
+        '''Returns a copy of the data that can be modified independently.'''
+        self._sort_functions()
+        other = FileCoverageDetails.__new__(FileCoverageDetails)
+        for slot in self.__slots__:
+            value = getattr(self, slot)
+            if isinstance(value, array.array):
+                value = value[:]
+            setattr(other, slot, value)
+        other._shared = False
+        return other
+
+    def digest(self):
+        '''Returns a hash of the data, equal for files with the same line,
+        function and branch data, whether the lines are stored densely or
+        sparsely. Function names are hashed by their ids, so only files sharing
+        a name table can be compared.'''
+        self._sort_functions()
+        h = hashlib.sha1()
+        # The lines are hashed in the form chosen by their density alone, so
+        # that the layout they are stored in, which depends on how they were
+        # added, does not matter. This is usually the stored one.
+        if self._lines is None:
+            lines, counts = self._sparse_lines, self._sparse_counts
+            size, nlines = lines[-1] + 1 if lines else 0, len(lines)
+        else:
+            # Leave out the trailing lines without data, which only depend on
+            # how the array grew. Those are all 0xff bytes; the last line with
+            # data is restored by rounding up to whole items.
+            data = self._lines.tostring()
+            itemsize = self._lines.itemsize
+            size = -(-len(data.rstrip('\xff')) // itemsize)
+            data, nlines = data[:size * itemsize], self._nlines
+        if size <= self.SPARSE_MIN_SIZE or \
+                nlines >= size * self.SPARSE_DENSITY:
+            if self._lines is None:
+                dense = _MISSING_LINES * size
+                for line, count in itertools.izip(lines, counts):
+                    dense[line] = count
+                data = dense.tostring()
+            parts = ['d', data]
+        else:
+            if self._lines is not None:
+                lines = array.array('l', (i for i, _ in self.lines()))
+                counts = array.array('l', (c for _, c in self.lines()))
+            parts = ['s', lines, counts]
+        parts.extend((self._fnames, self._flines, self._fcounts,
+            self._brlines, self._brblocks, self._brtargets, self._brcounts))
+        for part in parts:
+            if isinstance(part, array.array):
+                part = part.tostring()
+            h.update('%d:' % len(part))
+            h.update(part)
+        return h.digest()
+
+    def get_line_hit(self, line):
+        '''Returns the hit count of the line, or None if the line has no
+        coverage data.'''
+        lines = self._lines
+        if lines is None:
+            i = bisect.bisect_left(self._sparse_lines, line)
+            if i < len(self._sparse_lines) and self._sparse_lines[i] == line:
+                return self._sparse_counts[i]
+        elif line < len(lines) and lines[line] != -1:
+            return lines[line]
+        return None
+
+    def memory_size(self):
+        '''Returns the approximate number of bytes used by the data.'''
+        size = 0
+        for data in (self._lines, self._sparse_lines, self._sparse_counts,
+                     self._fnames, self._flines, self._fcounts, self._brlines,
+                     self._brblocks, self._brtargets, self._brcounts):
+            if data is not None:
+                size += len(data) * data.itemsize
+        return size
+
+    def summary(self):
+        '''Returns [lines, lines hit, functions, functions hit, branches,
+        branches hit] for the file.'''
+        counts = [0] * 6
+        for _, count in self.lines():
+            counts[0] += 1
+            counts[1] += count > 0
+        counts[2] = len(self._fcounts)
+        counts[3] = sum(count > 0 for count in self._fcounts)
+        counts[4] = len(self._brcounts)
+        counts[5] = sum(count != 0 for count in self._brcounts)
+        return counts
 
     def lines(self):
         '''Returns an iterator over (line #, hit count) for this file.'''
-        for i in xrange(len(self._lines)):
-            count = self._lines[i]
-            if count != -1:
-                yield (i, count)
+        if self._lines is None:
+            return itertools.izip(self._sparse_lines, self._sparse_counts)
+        # Filter out the missing lines without running any Python code per
+        # line.
+        return itertools.compress(
+            itertools.izip(itertools.count(), self._lines),
+            itertools.imap(_is_line_present, self._lines))
+
+    def lines_in_range(self, first, last):
+        '''Returns an iterator over (line #, hit count) for the lines from
+        first to last, inclusive.'''
+        first = max(first, 0)
+        if self._lines is None:
+            start = bisect.bisect_left(self._sparse_lines, first)
+            stop = bisect.bisect_right(self._sparse_lines, last, start)
+            return itertools.izip(self._sparse_lines[start:stop],
+                self._sparse_counts[start:stop])
+        lines = self._lines[first:last + 1]
+        return itertools.compress(
+            itertools.izip(itertools.count(first), lines),
+            itertools.imap(_is_line_present, lines))
+
+    def uncovered_line_count(self):
+        '''Returns the number of lines with data that were never hit.'''
+        if self._lines is None:
+            return self._sparse_counts.count(0)
+        return self._lines.count(0)
+
+    def uncovered_runs(self):
+        '''Returns a list of (first line, last line, lines) for every run of
+        lines with data that were never hit, where lines is the number of such
+        lines in the run. Lines without data do not end a run.'''
+        if self._lines is None:
+            present, counts = self._sparse_lines, self._sparse_counts
+        else:
+            lines = self._lines
+            mask = map(_is_line_present, lines)
+            present = list(itertools.compress(itertools.count(), mask))
+            counts = itertools.compress(lines, mask)
+        # Runs are found as runs of zero bytes in a string with a byte for
+        # every line with data, so that no Python code runs per line.
+        hits = str(bytearray(itertools.imap(operator.gt, counts,
+            itertools.repeat(0))))
+        return [(present[match.start()], present[match.end() - 1],
+                 match.end() - match.start())
+            for match in _uncovered_run_re.finditer(hits)]
+
+    def line_hit_changes(self, before):
+        '''Compares the line counts against an earlier run of the same file.
+        Returns a tuple of two lists: the lines that are hit here but were not
+        hit in before, and the lines that were hit in before but are not hit
+        here (including lines that no longer have any data).'''
+        ours, theirs = self._lines, before._lines
+        if ours is not None and theirs is not None:
+            if ours == theirs:
+                return [], []
+            pairs = enumerate(itertools.izip_longest(ours, theirs,
+                fillvalue=-1))
+        else:
+            ours, theirs = dict(self.lines()), dict(before.lines())
+            pairs = ((i, (ours.get(i, -1), theirs.get(i, -1)))
+                for i in sorted(set(ours) | set(theirs)))
+        covered, uncovered = [], []
+        for i, (now, then) in pairs:
+            if (now > 0) != (then > 0):
+                if now > 0:
+                    covered.append(i)
+                else:
+                    uncovered.append(i)
+        return covered, uncovered
 
     def add_function_hit(self, name, hitcount, lineno=None):
         '''Note that the function has been executed hitcount times. Optionally,
         if lineno is not None, note the line number of this function.'''
-        if not name in self._funcs:
-            self._funcs[name] = [lineno, 0]
-        fndata = self._funcs[name]
+        nameid = self._names.intern(name)
+        fnames = self._fnames
+        findex = self._findex
+        if findex is None:
+            if not fnames or nameid > fnames[-1]:
+                index = None
+            else:
+                index = bisect.bisect_left(fnames, nameid)
+                if fnames[index] != nameid:
+                    # Inserting would make loading quadratic; append until the
+                    # arrays are sorted again.
+                    findex = self._findex = dict(
+                        (fname, i) for i, fname in enumerate(fnames))
+                    index = None
+        else:
+            index = findex.get(nameid)
+        if index is None:
+            if findex is not None:
+                findex[nameid] = len(fnames)
+            fnames.append(nameid)
+            self._flines.append(-1 if lineno is None else lineno)
+            self._fcounts.append(hitcount)
+            return
         if lineno is not None:
-            fndata[0] = lineno
-        fndata[1] += hitcount
+            self._flines[index] = lineno
+        self._fcounts[index] += hitcount
+
+    def _sort_functions(self):
+        '''Sorts the function arrays by name id after functions were added out
+        of order.'''
+        if self._findex is None:
+            return
+        fnames, flines, fcounts = self._fnames, self._flines, self._fcounts
+        order = sorted(xrange(len(fnames)), key=fnames.__getitem__)
+        self._fnames = array.array('l', (fnames[i] for i in order))
+        self._flines = array.array('l', (flines[i] for i in order))
+        self._fcounts = array.array('l', (fcounts[i] for i in order))
+        self._findex = None
 
     def functions(self):
         '''Returns an iterator over (function name, line #, hit count) for this
         file.'''
-        for func, fndata in self._funcs.iteritems():
-            yield (func, fndata[0], fndata[1])
+        self._sort_functions()
+        name = self._names.name
+        for nameid, line, count in itertools.izip(self._fnames, self._flines,
+                self._fcounts):
+            yield (name(nameid), line if line != -1 else None, count)
+
+    def _function_table(self):
+        # Map of [name -> (line #, hit count)]
+        return dict((name, (line, count))
+            for name, line, count in self.functions())
 
     def add_branch_hit(self, lineno, brno, targetid, count):
         '''Note that the brno'th branch on the line number going to the targetid
         basic block has been executed count times.'''
-        brdata = self._branches.setdefault((lineno, brno), {})
-        brdata[targetid] = brdata.get(targetid, 0) + count
+        lines, blocks, targets = self._brlines, self._brblocks, self._brtargets
+        # Branches are almost always added in order.
+        if not lines or lineno > lines[-1] or (lineno == lines[-1] and
+                (brno, targetid) > (blocks[-1], targets[-1])):
+            lines.append(lineno)
+            blocks.append(brno)
+            targets.append(targetid)
+            self._brcounts.append(count)
+            return
+        index = bisect.bisect_left(lines, lineno)
+        end = bisect.bisect_right(lines, lineno, index)
+        while index < end and (blocks[index], targets[index]) < \
+                (brno, targetid):
+            index += 1
+        if index < end and blocks[index] == brno and targets[index] == targetid:
+            self._brcounts[index] += count
+            return
+        lines.insert(index, lineno)
+        blocks.insert(index, brno)
+        targets.insert(index, targetid)
+        self._brcounts.insert(index, count)
+
+    def add_branch_hits(self, hits):
+        '''Adds an iterable of (line #, branch #, target id, count) tuples at
+        once. This sorts the combined table a single time instead of inserting
+        each branch in turn.'''
+        merged = sorted(itertools.chain(self.branch_hits(), hits))
+        self._set_branch_hits(merged)
+
+    def merge_branches(self, otherdata):
+        '''Adds the branch counts of otherdata to this file.'''
+        if not self._brlines:
+            self._brlines = otherdata._brlines[:]
+            self._brblocks = otherdata._brblocks[:]
+            self._brtargets = otherdata._brtargets[:]
+            self._brcounts = otherdata._brcounts[:]
+        elif self._brlines == otherdata._brlines and \
+                self._brblocks == otherdata._brblocks and \
+                self._brtargets == otherdata._brtargets:
+            # The same branches, which is the norm across tests: just add up
+            # the counts.
+            self._brcounts = array.array('l', itertools.imap(operator.add,
+                self._brcounts, otherdata._brcounts))
+        else:
+            self.add_branch_hits(otherdata.branch_hits())
+
+    def _set_branch_hits(self, merged):
+        # Rebuilds the branch arrays from sorted (line, block, target, count)
+        # tuples, adding up the counts of duplicate entries.
+        lines, blocks = array.array('l'), array.array('l')
+        targets, counts = array.array('l'), array.array('l')
+        for key, group in itertools.groupby(merged, _branch_key):
+            lines.append(key[0])
+            blocks.append(key[1])
+            targets.append(key[2])
+            counts.append(sum(hit[3] for hit in group))
+        self._brlines, self._brblocks = lines, blocks
+        self._brtargets, self._brcounts = targets, counts
+
+    def branch_hits(self):
+        '''Returns an iterator over (line #, branch #, target id, count) for
+        this file, in sorted order.'''
+        return itertools.izip(self._brlines, self._brblocks, self._brtargets,
+            self._brcounts)
+
+    def branch_hits_in_range(self, first, last):
+        '''Returns an iterator over (line #, branch #, target id, count) for
+        the branches of the lines from first to last, inclusive.'''
+        start = bisect.bisect_left(self._brlines, first)
+        stop = bisect.bisect_right(self._brlines, last, start)
+        return itertools.izip(self._brlines[start:stop],
+            self._brblocks[start:stop], self._brtargets[start:stop],
+            self._brcounts[start:stop])
 
     def branches(self):
         '''Returns an iterator over (line #, branch #, [ids], [counts]) for this
-        file.'''
-        for tup in self._branches.iteritems():
-            items = tup[1].items()
-            items.sort()
-            yield (tup[0][0], tup[0][1], [x[0] for x in items], [x[1] for x in items])
+        file, sorted by line and branch number.'''
+        # Lists index faster than arrays, which box every item they return.
+        lines, blocks = self._brlines.tolist(), self._brblocks.tolist()
+        targets, counts = self._brtargets.tolist(), self._brcounts.tolist()
+        end = len(lines)
+        start = 0
+        while start < end:
+            line, block = lines[start], blocks[start]
+            stop = start + 1
+            while stop < end and lines[stop] == line and blocks[stop] == block:
+                stop += 1
+            yield (line, block, targets[start:stop], counts[start:stop])
+            start = stop
 
     def write_lcov_output(self, fd):
         '''Writes the record for this file to the file descriptor in the LCOV
@@ -106,55 +670,143 @@ class FileCoverageDetails(object):
         fd.write("end_of_record\n")
         pass
 
+    def differences(self, otherdata):
+        '''Returns an iterator over the differences between this data and
+        otherdata, as (kind, key, our value, their value) tuples, where kind is
+        'line', 'function' or 'branch'. Values missing on one side are None.
+        Differences are produced in line, function name and branch order.'''
+        # Lines: compare the arrays directly, and only walk them on mismatch.
+        ours, theirs = self._lines, otherdata._lines
+        if ours is None or theirs is None:
+            for difference in self._sparse_line_differences(otherdata):
+                yield difference
+        else:
+            common = min(len(ours), len(theirs))
+            if ours[:common] != theirs[:common]:
+                for i in xrange(common):
+                    if ours[i] != theirs[i]:
+                        yield ('line', i, ours[i] if ours[i] != -1 else None,
+                            theirs[i] if theirs[i] != -1 else None)
+            longer = ours if len(ours) > common else theirs
+            if longer[common:].count(-1) != len(longer) - common:
+                for i in xrange(common, len(longer)):
+                    if longer[i] != -1:
+                        if longer is ours:
+                            yield ('line', i, longer[i], None)
+                        else:
+                            yield ('line', i, None, longer[i])
+
+        self._sort_functions()
+        otherdata._sort_functions()
+        if self._names is not otherdata._names or \
+                self._fnames != otherdata._fnames or \
+                self._flines != otherdata._flines or \
+                self._fcounts != otherdata._fcounts:
+            ourfns = self._function_table()
+            theirfns = otherdata._function_table()
+            for name in sorted(set(ourfns) | set(theirfns)):
+                ourfn = ourfns.get(name)
+                theirfn = theirfns.get(name)
+                if ourfn != theirfn:
+                    yield ('function', name, ourfn, theirfn)
+
+        if self._brlines != otherdata._brlines or \
+                self._brblocks != otherdata._brblocks or \
+                self._brtargets != otherdata._brtargets or \
+                self._brcounts != otherdata._brcounts:
+            ourbrs = self._branch_table()
+            theirbrs = otherdata._branch_table()
+            for key in sorted(set(ourbrs) | set(theirbrs)):
+                ourbr = ourbrs.get(key)
+                theirbr = theirbrs.get(key)
+                if ourbr != theirbr:
+                    yield ('branch', key, ourbr, theirbr)
+
+    def _branch_table(self):
+        # Map of [(line #, branch #) -> [(target id, count)]]
+        return dict(((line, block), zip(ids, counts))
+            for line, block, ids, counts in self.branches())
+
+    def _sparse_line_differences(self, otherdata):
+        if self._lines is None and otherdata._lines is None and \
+                self._sparse_lines == otherdata._sparse_lines and \
+                self._sparse_counts == otherdata._sparse_counts:
+            return
+        ours, theirs = dict(self.lines()), dict(otherdata.lines())
+        for line in sorted(set(ours) | set(theirs)):
+            if ours.get(line) != theirs.get(line):
+                yield ('line', line, ours.get(line), theirs.get(line))
+
     def check_equivalency(self, otherdata):
-        if set(self.lines()) != set(otherdata.lines()):
-            return "Difference in line counts: %s" % format_set_difference(
-                set(self.lines()), set(otherdata.lines()))
-        if set(self.functions()) != set(otherdata.functions()):
-            return "Difference in function counts: %s" % format_set_difference(
-                set(self.functions()), set(otherdata.functions()))
-            return "Function counts differ"
-        ourbrs = set((x[0], x[1], tuple(x[2]), tuple(x[3]))
-            for x in self.branches())
-        theirbrs = set((x[0], x[1], tuple(x[2]), tuple(x[3]))
-            for x in otherdata.branches())
-        if ourbrs != theirbrs:
-            return "Difference in branch counts: %s" % format_set_difference(
-                ourbrs, theirbrs)
+        for difference in self.differences(otherdata):
+            return format_difference(difference)
+        return None
 
 class CoverageData:
     # data is a map of [testname -> fileData]
     # fileData is a map of [file -> FileCoverageDetails]
-    def __init__(self):
+    # fileTests is a map of [file -> set of testnames with data for the file]
+    # names is the table of function names shared by all of the files
+    # flatCache is an LRU map of [file -> (merged FileCoverageDetails, size)]
+    # for files with data from several tests, holding at most cacheLimit bytes
+    # of data.
+    # paths canonicalizes the paths of source files for all loaders
+    def __init__(self, cacheLimit=256 << 20, pathRewrites=()):
         self._data = {'': {}}
+        self._fileTests = {}
+        self._names = NameTable()
+        self.paths = PathResolver(pathRewrites)
+        self._flatCache = collections.OrderedDict()
+        self._flatCacheSize = 0
+        self.cacheLimit = cacheLimit
 
     def addFromLcovFile(self, fd):
         ''' Adds the data from the given file (in lcov format) to the current
             data tree. '''
-        fileData = self._data['']
+        test = ''
         # LCOV info files are line-based
         for line in fd:
             line = line.strip()
             instr, data = line.split(':', 1)
             if instr == 'TN': # TN:<test name>
-                fileData = self._data.setdefault(data, dict())
+                test = data
+                self._data.setdefault(data, dict())
                 continue
             elif instr == 'SF': # SF:<absolute path to the source file>
-                if os.path.islink(data):
-                    data = os.path.realpath(data)
-                CoverageData._addLcovData(fd,
-                    fileData.setdefault(data, FileCoverageDetails()))
+                self.addLcovRecord(test, data, fd)
             else:
                 raise Exception("Unknown line: %s" % line)
         fd.close()
 
+    def addLcovRecord(self, test, sourcefile, fd):
+        '''Adds one record of lcov data for the test and source file named by
+        its TN: and SF: lines. The rest of the record is read from fd, an
+        iterator of lines, up to and including end_of_record.'''
+        sourcefile = self.paths.resolve(sourcefile)
+        fileData = self._data.setdefault(test, dict())
+        self._fileTests.setdefault(sourcefile, set()).add(test)
+        self._invalidateFile(sourcefile)
+        if sourcefile not in fileData:
+            fileData[sourcefile] = FileCoverageDetails(self._names)
+        CoverageData._addLcovData(fd, self._unshare(fileData, sourcefile))
+        metrics.count('lcov-records')
+
+    @staticmethod
+    def readLcovRecord(fd, offset, fileStruct=None):
+        '''Reads the record starting at offset (as found by lcov_record_index)
+        of the lcov file into fileStruct, which is returned.'''
+        if fileStruct is None:
+            fileStruct = FileCoverageDetails()
+        fd.seek(offset)
+        CoverageData._addLcovData(fd, fileStruct)
+        return fileStruct
+
     @staticmethod
     def _addLcovData(fd, fileStruct):
-        # Lines and function count live in dicts
         for line in fd:
             line = line.strip()
             if line == 'end_of_record':
-                return
+                break
             instr, data = line.split(':', 1)
             if instr == 'DA': # DA:<line number>,<execution count>[,<checksum>]
                 data = data.split(',')
@@ -176,29 +828,28 @@ class CoverageData:
                 continue
             #else:
             #    raise Exception("Unknown line: %s" % line)
+        fileStruct._sort_functions()
 
     def writeLcovOutput(self, fd):
-        for test in self._data:
-            fileData = self._data[test]
-            for fname in fileData:
-                perFileData = fileData[fname]
-                fd.write('TN:%s\n' % test)
-                fd.write("SF:%s\n" % fname)
-                perFileData.write_lcov_output(fd)
-        fd.close()
+        with metrics.phase('write'):
+            for test in self._data:
+                fileData = self._data[test]
+                for fname in fileData:
+                    perFileData = fileData[fname]
+                    fd.write('TN:%s\n' % test)
+                    fd.write("SF:%s\n" % fname)
+                    perFileData.write_lcov_output(fd)
+                metrics.count('output-records', len(fileData))
+            fd.close()
 
     def loadGcdaTree(self, testname, gcdaDir):
-        import gcov
         if not testname in self._data:
             self._data[testname] = dict()
         if os.path.isfile(gcdaDir):
             dirpath = os.path.dirname(gcdaDir)
             gcda = os.path.basename(gcdaDir)
             gcno = gcda[:-2] + 'no'
-            gcnodata = gcov.GcnoData()
-            gcnodata.read_gcno_file(os.path.join(dirpath, gcno))
-            gcnodata.read_gcda_file(os.path.join(dirpath, gcda))
-            gcnodata.add_to_coverage(self, testname, dirpath)
+            self._loadGcdaFile(testname, dirpath, gcda, gcno)
             return
         for dirpath, dirnames, filenames in os.walk(gcdaDir):
             print 'Processing %s' % dirpath
@@ -207,18 +858,27 @@ class CoverageData:
             filepairs = [(da, no) for (da, no) in zip(gcda_files, gcno_files)
                 if no in filenames]
             for gcda, gcno in filepairs:
-                gcnodata = gcov.GcnoData()
-                gcnodata.read_gcno_file(os.path.join(dirpath, gcno))
-                gcnodata.read_gcda_file(os.path.join(dirpath, gcda))
-                gcnodata.add_to_coverage(self, testname, dirpath)
+                self._loadGcdaFile(testname, dirpath, gcda, gcno)
+
+    def _loadGcdaFile(self, testname, dirpath, gcda, gcno):
+        import gcov
+        gcnodata = gcov.GcnoData()
+        with metrics.phase('parse'):
+            gcnodata.read_gcno_file(os.path.join(dirpath, gcno))
+            gcnodata.read_gcda_file(os.path.join(dirpath, gcda))
+        with metrics.phase('solve'):
+            gcnodata.add_to_coverage(self, testname, dirpath)
+        metrics.count('gcda-files')
 
     def loadViaGcov(self, testname, dirwalk, gcovtool):
         dirwalk = os.path.abspath(dirwalk)
-        table = self._data.setdefault(testname, {})
+        table = self._unshareTest(testname)
         if os.path.isfile(dirwalk):
             basedir = os.path.dirname(dirwalk)
-            loader = GcovLoader(basedir, gcovtool, table=table)
+            loader = GcovLoader(basedir, gcovtool, table=table,
+                names=self._names, paths=self.paths)
             loader.loadDirectory(basedir, [os.path.basename(dirwalk)])
+            self._indexTest(testname, invalidate=True)
             return
 
         iterpaths = []
@@ -226,48 +886,206 @@ class CoverageData:
             iterpaths.append((dirpath,
                 filter(lambda x: x.endswith('.gcda'), filenames)))
         iterpaths = filter(lambda x: x[-1], iterpaths)
-        loader = GcovLoader(dirwalk, gcovtool, table=table)
+        loader = GcovLoader(dirwalk, gcovtool, table=table, names=self._names,
+            paths=self.paths)
         for directory, gcdas in iterpaths:
             loader.loadDirectory(directory, gcdas)
+        self._indexTest(testname, invalidate=True)
+
+    def loadPccountFile(self, testname, fd):
+        '''Adds the JavaScript coverage data of a pccount dump, the input of
+        pcc-js-coverage.js, for the test. Each line of the dump is a JSON list
+        of the base path of one execution followed by a [summary, contents]
+        pair for every script it ran; lines are parsed one at a time.'''
+        self._addPccountScripts(testname, iter_pccount_scripts(fd))
+        fd.close()
+
+    def _addPccountScripts(self, testname, scripts):
+        table = self._unshareTest(testname)
+        # Map of [(script filename, base path) -> source file or None]
+        sourcefiles = {}
+        for base, summary, opcodes in scripts:
+            key = (summary['file'], base)
+            if key not in sourcefiles:
+                sourcefiles[key] = self._pccountSourceFile(*key)
+            sourcefile = sourcefiles[key]
+            if sourcefile is None:
+                continue
+            if sourcefile not in table:
+                table[sourcefile] = FileCoverageDetails(self._names)
+            details = table[sourcefile]
+            if opcodes is not None:
+                # A line may have several opcodes; its count is that of the
+                # most executed one, which sorts last among them.
+                for lineno, count in sorted(dict(sorted(opcodes)).iteritems()):
+                    details.add_line_hit(lineno, count)
+            if summary.get('name'):
+                details.add_function_hit(summary['name'].encode('utf-8'),
+                    sum(summary['totals'].itervalues()), summary['line'])
+            metrics.count('pccount-scripts')
+        self._indexTest(testname, invalidate=True)
+
+    def _pccountSourceFile(self, filename, base):
+        # Script URLs may be chained, as in resource:///a -> resource:///b,
+        # where the last one is the actual script.
+        filename = filename.split(' -> ')[-1].encode('utf-8')
+        base = base.encode('utf-8')
+        if filename.startswith('file://'):
+            filename = filename[len('file://'):]
+        elif ':' in filename:
+            # Other URLs (resource:, chrome:) can only be mapped to files with
+            # prefix rewriting rules; unmapped ones are kept as they are.
+            if not any(filename.startswith(old)
+                       for old, _ in self.paths.rewrites):
+                return filename
+            base = None
+        # Scripts without a source file, such as eval code, are skipped.
+        resolved = self.paths.resolve(filename, base, PathResolver.RESOLVE_ALL)
+        return resolved if os.path.isfile(resolved) else None
 
     def getFlatData(self):
-        return self._getFlatData(self.getTests())
+        '''Returns a map of [file -> FileCoverageDetails] of the data merged
+        across all tests. The details are shared with this object and the
+        cache, and must not be modified.'''
+        return dict((file, self.getFlatFileData(file))
+            for file in self._fileTests)
+
+    def getFlatFileData(self, file):
+        '''Returns the data of the file merged across all tests, which must not
+        be modified. The data of a file with a single test is returned as is;
+        merged data is cached until the file changes or is evicted.'''
+        tests = self._fileTests.get(file, ())
+        if len(tests) == 1:
+            for test in tests:
+                return self._data[test][file]
+        entry = self._flatCache.pop(file, None)
+        if entry is not None:
+            metrics.count('flat-cache-hits')
+            self._flatCache[file] = entry
+            return entry[0]
+        metrics.count('flat-cache-misses')
+        fdata = FileCoverageDetails(self._names)
+        with metrics.phase('merge'):
+            for test in tests:
+                CoverageData._mergeFileData(fdata, self._data[test][file])
+        size = fdata.memory_size()
+        self._flatCache[file] = (fdata, size)
+        self._flatCacheSize += size
+        while self._flatCacheSize > self.cacheLimit and len(self._flatCache) > 1:
+            _, (_, evicted) = self._flatCache.popitem(last=False)
+            self._flatCacheSize -= evicted
+            metrics.count('flat-cache-evictions')
+        return fdata
+
+    def _invalidateFile(self, file):
+        if file in self._flatCache:
+            self._flatCacheSize -= self._flatCache.pop(file)[1]
 
     def getFileData(self, file, test):
-        data = FileCoverageDetails()
+        '''Returns the data of the file for the test, which must not be
+        modified; use get_or_add_file to add data.'''
         testdata = self._data[test]
-        return testdata.get(file, data)
+        if file in testdata:
+            return testdata[file]
+        return FileCoverageDetails(self._names)
+
+    def getTestsForFile(self, file):
+        '''Returns the names of the tests that have coverage data for the given
+        file. Tests not in this list have no coverage for the file at all.'''
+        return sorted(self._fileTests.get(file, ()))
+
+    def _indexTest(self, test, invalidate=False):
+        for file in self._data.get(test, {}):
+            self._fileTests.setdefault(file, set()).add(test)
+            if invalidate:
+                self._invalidateFile(file)
 
     def get_or_add_file(self, file, test):
-        return self._data.setdefault(test, dict()).setdefault(file,
-            FileCoverageDetails())
+        testdata = self._data.setdefault(test, dict())
+        if file not in testdata:
+            testdata[file] = FileCoverageDetails(self._names)
+            self._fileTests.setdefault(file, set()).add(test)
+        # The caller is about to add data to the file.
+        self._invalidateFile(file)
+        return self._unshare(testdata, file)
+
+    def _unshare(self, testdata, file):
+        # Copy-on-write: a test about to modify data that deduplicate shared
+        # with other tests gets a copy of its own.
+        details = testdata[file]
+        if details._shared:
+            details = testdata[file] = details.copy()
+            metrics.count('dedup-copies')
+        return details
+
+    def _unshareTest(self, test):
+        testdata = self._data.setdefault(test, {})
+        for file in testdata:
+            self._unshare(testdata, file)
+        return testdata
+
+    def deduplicate(self):
+        '''Makes the (test, file) entries with identical data share a single
+        FileCoverageDetails, as when several tests run the same code the same
+        way. Shared data is copied when one of its tests is added to. Returns
+        (entries, distinct entries, bytes of data freed).'''
+        # Map of [digest -> FileCoverageDetails]
+        canonical = {}
+        entries = 0
+        saved = 0
+        with metrics.phase('dedup'):
+            for test in sorted(self._data):
+                testdata = self._data[test]
+                for file in sorted(testdata):
+                    details = testdata[file]
+                    entries += 1
+                    first = canonical.setdefault(details.digest(), details)
+                    if first is not details:
+                        testdata[file] = first
+                        first._shared = True
+                        saved += details.memory_size()
+        metrics.count('dedup-entries', entries)
+        metrics.count('dedup-shared', entries - len(canonical))
+        return entries, len(canonical), saved
 
     def _getFlatData(self, keys):
+        '''Returns new data merged across the given tests, bypassing the
+        cache.'''
         data = {}
-        for test in keys:
-            testdata = self._data[test]
-            for file in testdata:
-                fdata = data.setdefault(file, FileCoverageDetails())
-                tfdata = testdata[file]
-                # Merge line data in
-                for line, lh in tfdata.lines():
-                    fdata.add_line_hit(line, lh)
-                # Merge in function data
-                for func, line, fh in tfdata.functions():
-                    fdata.add_function_hit(func, fh, line)
-                # Branch data
-                for line, branch, ids, counts in tfdata.branches():
-                    for brid, count in zip(ids, counts):
-                        fdata.add_branch_hit(line, branch, brid, count)
+        with metrics.phase('merge'):
+            for test in keys:
+                testdata = self._data[test]
+                for file in testdata:
+                    if file not in data:
+                        data[file] = FileCoverageDetails(self._names)
+                    CoverageData._mergeFileData(data[file], testdata[file])
+                metrics.count('merged-records', len(testdata))
         return data
 
+    @staticmethod
+    def _mergeFileData(fdata, tfdata):
+        # Merge line data in
+        for line, lh in tfdata.lines():
+            fdata.add_line_hit(line, lh)
+        # Merge in function data
+        for func, line, fh in tfdata.functions():
+            fdata.add_function_hit(func, fh, line)
+        # Branch data
+        fdata.merge_branches(tfdata)
+
     def getTestData(self, test):
-        return self._getFlatData([test])
+        '''Returns the map of [file -> FileCoverageDetails] of the test. This
+        is the data itself, not a copy, and must not be modified.'''
+        return self._data[test]
 
     def getTests(self):
         return self._data.keys()
 
     def filterFilesByGlob(self, glob):
+        with metrics.phase('filter'):
+            self._filterFilesByGlob(glob)
+
+    def _filterFilesByGlob(self, glob):
         newdata = {}
         for test in self._data:
             testdata = self._data[test]
@@ -277,17 +1095,20 @@ class CoverageData:
             if len(newtestdata) > 0:
                 newdata[test] = newtestdata
         self._data = newdata
+        self._fileTests = {}
+        for test in self._data:
+            self._indexTest(test)
+        # Cached data of the remaining files is still valid, as a file is
+        # either kept or dropped for all tests.
+        for file in [f for f in self._flatCache if f not in self._fileTests]:
+            self._invalidateFile(file)
 
     def checkEquivalency(self, otherData):
         if set(self.getTests()) != set(otherData.getTests()):
             return "Difference in tests"
         for test in self.getTests():
-            ourfiles = set(self._data[test].keys())
-            theirfiles = set(otherData._data[test].keys())
-            diff = format_set_difference(ourfiles, theirfiles)
-            #if diff:
-            #    return "Difference in files: " + diff
-            for f in ourfiles:
+            ourfiles = self._data[test].keys()
+            for f in sorted(ourfiles):
                 result = self.getFileData(f, test).check_equivalency(
                     otherData.getFileData(f, test))
                 if result:
@@ -295,22 +1116,30 @@ class CoverageData:
         return None
 
 class GcovLoader(object):
-    def __init__(self, basedir, gcovtool='gcov', table={}):
+    def __init__(self, basedir, gcovtool='gcov', table={}, names=None,
+                 paths=None):
         self.gcovtool = gcovtool
         self.basedir = basedir
         self.table = table
+        self.names = names
+        self.paths = paths if paths is not None else PathResolver()
 
     def loadDirectory(self, directory, gcda_files):
         print 'Processing %s' % directory
         gcda_files = map(lambda f: os.path.join(directory, f), gcda_files)
         gcovdir = tempfile.mktemp("gcovdir")
         os.mkdir(gcovdir)
-        with open('/dev/null', 'w') as hideOutput:
-            subprocess.check_call([self.gcovtool, "-b", "-c", "-a", "-f"] +
-                gcda_files, cwd=gcovdir, stdout=hideOutput, stderr=hideOutput)
-        for gcovfile in os.listdir(gcovdir):
-            with open(os.path.join(gcovdir, gcovfile)) as fd:
-                self._readGcovFile(fd, directory)
+        with metrics.phase('gcov'):
+            with open('/dev/null', 'w') as hideOutput:
+                subprocess.check_call([self.gcovtool, "-b", "-c", "-a", "-f"] +
+                    gcda_files, cwd=gcovdir, stdout=hideOutput,
+                    stderr=hideOutput)
+        metrics.count('gcda-files', len(gcda_files))
+        with metrics.phase('parse'):
+            for gcovfile in os.listdir(gcovdir):
+                with open(os.path.join(gcovdir, gcovfile)) as fd:
+                    self._readGcovFile(fd, directory)
+                metrics.count('gcov-files')
         shutil.rmtree(gcovdir)
 
     def _readGcovFile(self, fd, relpath):
@@ -330,10 +1159,11 @@ class GcovLoader(object):
                 if lineno == 0 and data.startswith('Source:'):
                     # Build the filename
                     filename = data[data.find(':')+1:]
-                    filename = os.path.abspath(os.path.join(relpath, filename))
+                    filename = self.paths.resolve(filename,
+                        os.path.abspath(relpath), PathResolver.KEEP_LINKS)
                     # Set the accumulator tables
                     if not filename in self.table:
-                        fulltable = FileCoverageDetails()
+                        fulltable = FileCoverageDetails(self.names)
                         self.table[filename] = fulltable
                     else:
                         fulltable = self.table[filename]
@@ -377,28 +1207,98 @@ def main(argv):
         help="Collect data from gcov results", metavar="DIR")
     o.add_option('--gcov-tool', dest="gcov_tool", default="gcov",
         help="Version of gcov to use to extract data")
+    o.add_option('-j', '--add-pccount', dest="pccount_files", action="append",
+        help="Add JavaScript coverage data from a pccount dump, as read by "
+             "pcc-js-coverage.js", metavar="FILE")
     o.add_option('-e', '--extract', dest="extract_glob",
         help="Extract only data for files matching PATTERN", metavar="PATTERN")
     o.add_option('-o', '--output', dest="outfile",
         help="File to output data to", metavar="FILE")
     o.add_option('-t', '--test-name', dest="testname",
         help="Use the NAME for the name of the test", metavar="NAME")
+    o.add_option('--external-merge', dest="external_merge",
+        action="store_true", default=False,
+        help="Merge via sorted temporary files instead of in memory")
+    o.add_option('--memory-limit', dest="memory_limit", type="int",
+        default=256, help="Buffer at most MB of data in memory when using "
+        "--external-merge", metavar="MB")
+    o.add_option('--merge-width', dest="merge_width", type="int", default=64,
+        help="Keep at most N temporary files open at once when using "
+        "--external-merge", metavar="N")
+    o.add_option('--tmpdir', dest="tmpdir",
+        help="Store temporary files for --external-merge in DIR",
+        metavar="DIR")
+    o.add_option('--rewrite-prefix', dest="rewrites", action="append",
+        help="Replace the prefix OLD of source file paths with NEW, such as "
+             "an object directory with the source directory",
+        metavar="OLD=NEW")
+    o.add_option('--stream', dest="stream",
+        help="Merge lcov data as it is written to SOURCE, which is - for "
+             "standard input, a named pipe or a directory of .info files, "
+             "writing snapshots to the output file", metavar="SOURCE")
+    o.add_option('--flush-interval', dest="flush_interval", type="float",
+        default=30, help="Write a snapshot of the data streamed so far every "
+        "SECONDS when it changed", metavar="SECONDS")
+    o.add_option('--stream-idle', dest="stream_idle", type="float",
+        help="Stop streaming once no data arrived for SECONDS",
+        metavar="SECONDS")
+    o.add_option('--metrics', dest="metrics_file",
+        help="Write timings, item counts and peak memory usage of the run "
+             "as JSON to FILE", metavar="FILE")
+    o.add_option('--profile', dest="profile_file",
+        help="Run under cProfile and dump the statistics to FILE",
+        metavar="FILE")
     (opts, args) = o.parse_args(argv)
+    opts.rewrites = [rule.split('=', 1) for rule in (opts.rewrites or [])]
+    if [rule for rule in opts.rewrites if len(rule) != 2]:
+        o.error("--rewrite-prefix needs OLD=NEW")
 
-    # Load coverage data
-    coverage = CoverageData()
+    if opts.stream is not None:
+        if opts.outfile is None:
+            o.error("--stream needs -o")
+        run = lambda: streamMerge(opts)
+    elif opts.external_merge:
+        run = lambda: externalMerge(opts)
+    else:
+        run = lambda: inMemoryMerge(opts)
+    metrics.run(run, opts.profile_file, opts.metrics_file)
+
+def reportPathCache(paths):
+    paths.report(sys.stderr)
+    stats = paths.stats()
+    for key in ('hits', 'lookups', 'syscalls-saved'):
+        metrics.count('path-cache-' + key, stats[key])
+
+def loadInputs(coverage, opts):
+    '''Loads the lcov files, gcov and gcda directories and pccount dumps of
+    the command line into coverage.'''
     if opts.more_files == None: opts.more_files = []
     for lcovFile in opts.more_files:
         print >> sys.stderr, "Reading file %s" % lcovFile
         fd = open(lcovFile, 'r')
-        coverage.addFromLcovFile(fd)
+        with metrics.measure_input(lcovFile, 'lcov', 'lcov-records'):
+            with metrics.phase('parse'):
+                coverage.addFromLcovFile(fd)
 
     if opts.gcda_dirs == None: opts.gcda_dirs = []
     test = opts.testname or ''
     for gcdaDir in opts.gcda_dirs:
-        coverage.loadGcdaTree(test, gcdaDir)
+        with metrics.measure_input(gcdaDir, 'gcda', 'gcda-files'):
+            coverage.loadGcdaTree(test, gcdaDir)
     for gcovdir in (opts.gcov_dirs or []):
-        coverage.loadViaGcov(test, gcovdir, opts.gcov_tool)
+        with metrics.measure_input(gcovdir, 'gcov', 'gcda-files'):
+            coverage.loadViaGcov(test, gcovdir, opts.gcov_tool)
+    for pccFile in (opts.pccount_files or []):
+        print >> sys.stderr, "Reading file %s" % pccFile
+        with metrics.measure_input(pccFile, 'pccount', 'pccount-scripts'):
+            with metrics.phase('parse'):
+                coverage.loadPccountFile(test, open(pccFile, 'r'))
+
+def inMemoryMerge(opts):
+    # Load coverage data
+    coverage = CoverageData(pathRewrites=opts.rewrites)
+    loadInputs(coverage, opts)
+    reportPathCache(coverage.paths)
 
     if opts.extract_glob is not None:
         coverage.filterFilesByGlob(opts.extract_glob)
@@ -411,5 +1311,66 @@ def main(argv):
     coverage.writeLcovOutput(outfd)
     outfd.close()
 
+def streamMerge(opts):
+    from lcovstream import StreamingMerger
+    merger = StreamingMerger(opts.outfile, opts.flush_interval,
+        opts.extract_glob, CoverageData(pathRewrites=opts.rewrites))
+    # Data that is already complete is loaded before streaming starts.
+    loadInputs(merger.coverage, opts)
+    if opts.extract_glob is not None:
+        merger.coverage.filterFilesByGlob(opts.extract_glob)
+    print >> sys.stderr, "Streaming from %s to %s" % (opts.stream,
+        opts.outfile)
+    merger.run(opts.stream, opts.stream_idle)
+    merger.report(sys.stderr)
+    reportPathCache(merger.coverage.paths)
+
+def externalMerge(opts):
+    from extmerge import ExternalMerger
+    paths = PathResolver(opts.rewrites)
+    merger = ExternalMerger(opts.memory_limit << 20, opts.extract_glob,
+        opts.tmpdir, paths, opts.merge_width)
+    try:
+        for lcovFile in (opts.more_files or []):
+            print >> sys.stderr, "Reading file %s" % lcovFile
+            with metrics.measure_input(lcovFile, 'lcov', 'lcov-records'):
+                with metrics.phase('parse'):
+                    merger.addFromLcovFile(open(lcovFile, 'r'))
+
+        # Data collected from gcda files and pccount dumps is converted to
+        # lcov and merged too.
+        test = opts.testname or ''
+        if opts.gcda_dirs or opts.gcov_dirs or opts.pccount_files:
+            coverage = CoverageData()
+            coverage.paths = paths
+            for gcdaDir in (opts.gcda_dirs or []):
+                with metrics.measure_input(gcdaDir, 'gcda', 'gcda-files'):
+                    coverage.loadGcdaTree(test, gcdaDir)
+            for gcovdir in (opts.gcov_dirs or []):
+                with metrics.measure_input(gcovdir, 'gcov', 'gcda-files'):
+                    coverage.loadViaGcov(test, gcovdir, opts.gcov_tool)
+            for pccFile in (opts.pccount_files or []):
+                with metrics.measure_input(pccFile, 'pccount',
+                        'pccount-scripts'):
+                    with metrics.phase('parse'):
+                        coverage.loadPccountFile(test, open(pccFile, 'r'))
+            collected = tempfile.TemporaryFile()
+            coverage.writeLcovOutput(os.fdopen(os.dup(collected.fileno()), 'w'))
+            del coverage
+            collected.seek(0)
+            merger.addFromLcovFile(collected)
+
+        if opts.outfile != None:
+            print >> sys.stderr, "Writing to file %s" % opts.outfile
+            outfd = open(opts.outfile, 'w')
+        else:
+            outfd = sys.stdout
+        with metrics.phase('merge'):
+            merger.writeLcovOutput(outfd)
+        merger.report(sys.stderr)
+        reportPathCache(paths)
+    finally:
+        merger.close()
+
 if __name__ == '__main__':
     main(sys.argv[1:])
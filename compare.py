@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+'''Compare two sets of coverage data and report every difference.
+
+The comparison is done one file at a time. When comparing lcov files, only the
+offsets of their records are held in memory, and each file's records are read
+from both sides, compared and dropped before moving on to the next one.'''
+
+import sys
+from ccov import CoverageData, FileCoverageDetails, NameTable, \
+    format_difference, lcov_record_index
+
+class CoverageComparison(object):
+    '''Accumulates the differences between two sets of coverage data. If fd is
+    given, each difference is written to it as it is found.'''
+
+    KINDS = ('line', 'function', 'branch')
+
+    def __init__(self, fd=None):
+        self.fd = fd
+        self.files = 0
+        self.differing_files = 0
+        self.only_ours = 0
+        self.only_theirs = 0
+        self.counts = dict((kind, 0) for kind in self.KINDS)
+
+    def compare_file(self, test, filename, ours, theirs):
+        '''Compares the data of one file for one test. Either side may be None
+        if the file is absent from that data set.'''
+        self.files += 1
+        if ours is None or theirs is None:
+            self.differing_files += 1
+            if ours is None:
+                self.only_theirs += 1
+                self._report(test, filename, "Only in second data set")
+            else:
+                self.only_ours += 1
+                self._report(test, filename, "Only in first data set")
+            return
+        differs = False
+        for difference in ours.differences(theirs):
+            differs = True
+            self.counts[difference[0]] += 1
+            self._report(test, filename, format_difference(difference))
+        self.differing_files += differs
+
+    def _report(self, test, filename, message):
+        if self.fd is not None:
+            self.fd.write("%s for %s on test %s\n" % (message, filename, test))
+
+    def is_equivalent(self):
+        return self.differing_files == 0
+
+    def summary(self):
+        '''Returns the summary statistics of the comparison as a dict.'''
+        result = {'files': self.files, 'differing-files': self.differing_files,
+                  'only-first': self.only_ours, 'only-second': self.only_theirs}
+        for kind in self.KINDS:
+            result[kind + '-differences'] = self.counts[kind]
+        return result
+
+    def write_summary(self, fd):
+        fd.write("Compared %d files: %d differ (%d only in first, "
+            "%d only in second)\n" % (self.files, self.differing_files,
+            self.only_ours, self.only_theirs))
+        fd.write("Differences: %d lines, %d functions, %d branches\n" % tuple(
+            self.counts[kind] for kind in self.KINDS))
+
+def compare_coverage(ours, theirs, comparison):
+    '''Compares two CoverageData objects file by file.'''
+    ourtests, theirtests = set(ours.getTests()), set(theirs.getTests())
+    for test in sorted(ourtests | theirtests):
+        ourfiles = ours.getTestData(test) if test in ourtests else {}
+        theirfiles = theirs.getTestData(test) if test in theirtests else {}
+        for filename in sorted(set(ourfiles) | set(theirfiles)):
+            comparison.compare_file(test, filename, ourfiles.get(filename),
+                theirfiles.get(filename))
+    return comparison
+
+def _group_records(lcovfile):
+    # Map of [(test, file) -> [offsets]]; a file may occur in several records.
+    records = {}
+    for test, filename, offset in lcov_record_index(lcovfile):
+        records.setdefault((test, filename), []).append(offset)
+    return records
+
+def _read_records(fd, offsets, names):
+    if offsets is None:
+        return None
+    data = FileCoverageDetails(names)
+    for offset in offsets:
+        CoverageData.readLcovRecord(fd, offset, data)
+    return data
+
+def compare_lcov_files(ourfile, theirfile, comparison):
+    '''Compares two lcov files, holding only one file's data at a time.'''
+    ourrecords = _group_records(ourfile)
+    theirrecords = _group_records(theirfile)
+    with open(ourfile, 'r') as ourfd:
+        with open(theirfile, 'r') as theirfd:
+            for key in sorted(set(ourrecords) | set(theirrecords)):
+                # Both sides share a name table so functions compare by id.
+                names = NameTable()
+                comparison.compare_file(key[0], key[1],
+                    _read_records(ourfd, ourrecords.get(key), names),
+                    _read_records(theirfd, theirrecords.get(key), names))
+    return comparison
+
+def main(argv):
+    from optparse import OptionParser
+    o = OptionParser(usage="%prog [options] FIRST.info SECOND.info\n"
+        "       %prog [options] --collect DIR")
+    o.add_option('--collect', dest="collect_dir",
+        help="Compare the experimental gcda collector against gcov for the "
+             "gcda files in DIR", metavar="DIR")
+    o.add_option('--gcov-tool', dest="gcov_tool", default="gcov",
+        help="Version of gcov to use to extract data")
+    o.add_option('-q', '--quiet', dest="quiet", action="store_true",
+        default=False, help="Only print the summary")
+    (opts, args) = o.parse_args(argv)
+
+    comparison = CoverageComparison(None if opts.quiet else sys.stdout)
+    if opts.collect_dir is not None:
+        ours, theirs = CoverageData(), CoverageData()
+        ours.loadGcdaTree('', opts.collect_dir)
+        theirs.loadViaGcov('', opts.collect_dir, opts.gcov_tool)
+        compare_coverage(ours, theirs, comparison)
+    elif len(args) == 2:
+        compare_lcov_files(args[0], args[1], comparison)
+    else:
+        o.error("Need two lcov files or --collect")
+    comparison.write_summary(sys.stdout)
+    sys.exit(0 if comparison.is_equivalent() else 1)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,292 @@
+#!/usr/bin/python
+
+'''A SQLite store of coverage data.
+
+The line, function and branch data of every (test, file) pair is bulk-loaded
+into a database, along with per-file summaries for each test and for all tests
+merged, so that questions about parts of the tree can be answered from the
+indexes without loading all of the data. Rows with a NULL test in the summary
+table hold the data merged across tests.
+
+Usage:
+  covdb.py build -o DATABASE [-a LCOVFILE]... [-c GCOVDIR]... [-t TEST]
+  covdb.py files DATABASE [--prefix DIR] [-t TEST] [--below KIND:PCT]
+  covdb.py functions DATABASE [--prefix DIR] [-t TEST]
+  covdb.py export DATABASE [-t TEST] -o LCOVFILE FILE...'''
+
+import sqlite3
+import sys
+from ccov import CoverageData, FileCoverageDetails
+
+SCHEMA = '''
+CREATE TABLE tests (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE files (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL);
+CREATE TABLE lines (test INTEGER NOT NULL, file INTEGER NOT NULL,
+    line INTEGER NOT NULL, count INTEGER NOT NULL);
+CREATE TABLE functions (test INTEGER NOT NULL, file INTEGER NOT NULL,
+    name TEXT NOT NULL, line INTEGER, count INTEGER NOT NULL);
+CREATE TABLE branches (test INTEGER NOT NULL, file INTEGER NOT NULL,
+    line INTEGER NOT NULL, block INTEGER NOT NULL, target INTEGER NOT NULL,
+    count INTEGER NOT NULL);
+CREATE TABLE summary (test INTEGER, file INTEGER NOT NULL,
+    lines INTEGER, lines_hit INTEGER, funcs INTEGER, funcs_hit INTEGER,
+    branches INTEGER, branches_hit INTEGER);
+'''
+
+# Created after the bulk load, which is faster than maintaining them.
+INDEXES = '''
+CREATE INDEX lines_file ON lines (file, test, line);
+CREATE INDEX functions_file ON functions (file, test);
+CREATE INDEX branches_file ON branches (file, test, line);
+CREATE INDEX summary_test ON summary (test, file);
+CREATE INDEX summary_file ON summary (file, test);
+'''
+
+KINDS = ('lines', 'funcs', 'branches')
+
+# Rows are inserted in batches of this many per executemany call.
+BATCH_SIZE = 10000
+
+def _batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _prefix_range(prefix):
+    # Paths are compared bytewise, and no UTF-8 string contains a 0xff byte.
+    return prefix, prefix + '\xff'
+
+class CoverageStore(object):
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.text_factory = str
+
+    def close(self):
+        self.db.close()
+
+    def load(self, covdata):
+        '''Replaces the contents of the database with the data of a
+        CoverageData, in a single transaction.'''
+        db = self.db
+        db.executescript(''.join('DROP TABLE IF EXISTS %s;\n' % table
+            for table in ('tests', 'files', 'lines', 'functions', 'branches',
+                          'summary')) + SCHEMA)
+        with db:
+            tests = sorted(covdata.getTests())
+            db.executemany('INSERT INTO tests VALUES (?, ?)',
+                enumerate(tests))
+            testids = dict((test, i) for i, test in enumerate(tests))
+            files = sorted(set(file for test in tests
+                for file in covdata.getTestData(test)))
+            db.executemany('INSERT INTO files VALUES (?, ?)', enumerate(files))
+            fileids = dict((file, i) for i, file in enumerate(files))
+            self._insert('lines', 4, ((testids[test], fileids[file], line,
+                count)
+                for test in tests
+                for file, details in covdata.getTestData(test).iteritems()
+                for line, count in details.lines()))
+            self._insert('functions', 5, ((testids[test], fileids[file], name,
+                line, count)
+                for test in tests
+                for file, details in covdata.getTestData(test).iteritems()
+                for name, line, count in details.functions()))
+            self._insert('branches', 6, ((testids[test], fileids[file]) + hit
+                for test in tests
+                for file, details in covdata.getTestData(test).iteritems()
+                for hit in details.branch_hits()))
+            self._insert('summary', 8, ((testids[test], fileids[file]) +
+                tuple(details.summary())
+                for test in tests
+                for file, details in covdata.getTestData(test).iteritems()))
+            self._insert('summary', 8, ((None, fileids[file]) +
+                tuple(covdata.getFlatFileData(file).summary())
+                for file in files))
+        db.executescript(INDEXES)
+
+    def _insert(self, table, columns, rows):
+        statement = 'INSERT INTO %s VALUES (%s)' % (table,
+            ', '.join('?' * columns))
+        for batch in _batches(rows):
+            self.db.executemany(statement, batch)
+
+    def tests(self):
+        return [name for name, in
+            self.db.execute('SELECT name FROM tests ORDER BY name')]
+
+    def _test_id(self, test):
+        if test is None:
+            return None
+        row = self.db.execute('SELECT id FROM tests WHERE name = ?',
+            (test,)).fetchone()
+        if row is None:
+            raise KeyError("No test named %s" % test)
+        return row[0]
+
+    def file_summaries(self, prefix='', test=None, below=None):
+        '''Returns (path, [lines, lines hit, functions, functions hit,
+        branches, branches hit]) for the files whose path starts with prefix,
+        for one test or all tests merged. below may be a (kind, ratio) pair,
+        where kind is one of KINDS, to only return files with some data of
+        that kind and less than ratio of it hit.'''
+        query = ('SELECT path, lines, lines_hit, funcs, funcs_hit, branches, '
+            'branches_hit FROM files JOIN summary ON summary.file = files.id '
+            'WHERE path >= ? AND path < ? AND summary.test IS ?')
+        params = list(_prefix_range(prefix)) + [self._test_id(test)]
+        if below is not None:
+            kind, ratio = below
+            if kind not in KINDS:
+                raise ValueError("Unknown kind %s" % kind)
+            query += ' AND %s > 0 AND %s_hit < ? * %s' % (kind, kind, kind)
+            params.append(ratio)
+        query += ' ORDER BY path'
+        return [(row[0], list(row[1:]))
+            for row in self.db.execute(query, params)]
+
+    def uncovered_functions(self, prefix='', test=None):
+        '''Returns (path, function name, line) for the functions in files
+        whose path starts with prefix that were never called.'''
+        testid = self._test_id(test)
+        if testid is None:
+            # A function may only be called by some tests.
+            query = ('SELECT path, name, MAX(line) FROM files JOIN functions '
+                'ON functions.file = files.id WHERE path >= ? AND path < ? '
+                'GROUP BY path, name HAVING MAX(count) = 0 '
+                'ORDER BY path, MAX(line), name')
+            params = _prefix_range(prefix)
+        else:
+            query = ('SELECT path, name, line FROM files JOIN functions '
+                'ON functions.file = files.id WHERE path >= ? AND path < ? '
+                'AND test = ? AND count = 0 ORDER BY path, line, name')
+            params = _prefix_range(prefix) + (testid,)
+        return self.db.execute(query, params).fetchall()
+
+    def file_details(self, path, test=None):
+        '''Returns the FileCoverageDetails of one file for the test, or
+        merged across all tests, or None if the file has no data.'''
+        row = self.db.execute('SELECT id FROM files WHERE path = ?',
+            (path,)).fetchone()
+        if row is None:
+            return None
+        details = FileCoverageDetails()
+        self._read_details(row[0], self._test_id(test), details)
+        return details
+
+    def _read_details(self, fileid, testid, details):
+        if testid is None:
+            where, params = 'file = ?', (fileid,)
+        else:
+            where, params = 'file = ? AND test = ?', (fileid, testid)
+        for line, count in self.db.execute('SELECT line, SUM(count) FROM lines '
+                'WHERE %s GROUP BY line ORDER BY line' % where, params):
+            details.add_line_hit(line, count)
+        for name, line, count in self.db.execute('SELECT name, MAX(line), '
+                'SUM(count) FROM functions WHERE %s GROUP BY name' % where,
+                params):
+            details.add_function_hit(name, count, line)
+        details.add_branch_hits(self.db.execute('SELECT line, block, target, '
+            'SUM(count) FROM branches WHERE %s GROUP BY line, block, target '
+            'ORDER BY line, block, target' % where, params))
+
+    def load_coverage(self, paths, tests=None):
+        '''Returns a CoverageData holding only the data of the given files for
+        the given tests (all tests by default).'''
+        covdata = CoverageData()
+        for test in (tests if tests is not None else self.tests()):
+            testid = self._test_id(test)
+            for path in paths:
+                # Every (test, file) pair of the data has a summary row.
+                row = self.db.execute('SELECT files.id FROM files JOIN summary '
+                    'ON summary.file = files.id WHERE path = ? AND test = ?',
+                    (path, testid)).fetchone()
+                if row is not None:
+                    self._read_details(row[0], testid,
+                        covdata.get_or_add_file(path, test))
+        return covdata
+
+def _format_summary(counts):
+    return ', '.join('%s %d/%d' % (kind, counts[2 * i + 1], counts[2 * i])
+        for i, kind in enumerate(KINDS))
+
+def main(argv):
+    from optparse import OptionParser
+    commands = ('build', 'files', 'functions', 'export')
+    if not argv or argv[0] not in commands:
+        print >> sys.stderr, __doc__.split('Usage:')[1].strip('\n')
+        sys.exit(1)
+    command, argv = argv[0], argv[1:]
+    if command == 'build':
+        o = OptionParser(usage="%prog build -o DATABASE [options]")
+        o.add_option('-o', '--output', dest="outfile",
+            help="Database to write to", metavar="FILE")
+        o.add_option('-a', '--add', dest="more_files", action="append",
+            help="Add contents of coverage data", metavar="FILE")
+        o.add_option('--experimental-collect', dest="gcda_dirs",
+            action="append", help="Collect data from gcov results",
+            metavar="DIR")
+        o.add_option('-c', '--gcov-collect', dest="gcov_dirs", action="append",
+            help="Collect data from gcov results", metavar="DIR")
+        o.add_option('--gcov-tool', dest="gcov_tool", default="gcov",
+            help="Version of gcov to use to extract data")
+        o.add_option('-t', '--test-name', dest="testname",
+            help="Use the NAME for the name of the test", metavar="NAME")
+        (opts, args) = o.parse_args(argv)
+        if opts.outfile is None:
+            o.error("Need to pass in -o!")
+        coverage = CoverageData()
+        for lcovFile in (opts.more_files or []):
+            print >> sys.stderr, "Reading file %s" % lcovFile
+            coverage.addFromLcovFile(open(lcovFile, 'r'))
+        test = opts.testname or ''
+        for gcdaDir in (opts.gcda_dirs or []):
+            coverage.loadGcdaTree(test, gcdaDir)
+        for gcovdir in (opts.gcov_dirs or []):
+            coverage.loadViaGcov(test, gcovdir, opts.gcov_tool)
+        store = CoverageStore(opts.outfile)
+        store.load(coverage)
+        store.close()
+        return
+
+    o = OptionParser(usage="%%prog %s DATABASE [options]" % command)
+    o.add_option('--prefix', dest="prefix", default='',
+        help="Only consider files whose path starts with PREFIX",
+        metavar="PREFIX")
+    o.add_option('-t', '--test-name', dest="testname",
+        help="Only consider the data of test NAME", metavar="NAME")
+    if command == 'files':
+        o.add_option('--below', dest="below",
+            help="Only list files with less than PCT%% of their lines, funcs "
+                 "or branches hit", metavar="KIND:PCT")
+    elif command == 'export':
+        o.add_option('-o', '--output', dest="outfile",
+            help="File to write the lcov data to", metavar="FILE")
+    (opts, args) = o.parse_args(argv)
+    if not args:
+        o.error("Need a database")
+    store = CoverageStore(args[0])
+    if command == 'files':
+        below = None
+        if opts.below is not None:
+            kind, _, percent = opts.below.partition(':')
+            below = (kind, float(percent) / 100)
+        for path, counts in store.file_summaries(opts.prefix, opts.testname,
+                below):
+            print '%s: %s' % (path, _format_summary(counts))
+    elif command == 'functions':
+        for path, name, line in store.uncovered_functions(opts.prefix,
+                opts.testname):
+            print '%s:%s: %s' % (path, line if line is not None else '?', name)
+    else:
+        if opts.outfile is None:
+            o.error("Need to pass in -o!")
+        tests = [opts.testname] if opts.testname is not None else None
+        store.load_coverage(args[1:], tests).writeLcovOutput(
+            open(opts.outfile, 'w'))
+    store.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
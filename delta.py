@@ -0,0 +1,160 @@
+#!/usr/bin/python
+
+'''Coverage changes between two runs, such as two consecutive nightlies.
+
+Both runs are loaded into CoverageData and flattened across tests (or limited
+to a single test). Files are aligned by name; files in which no line,
+function or branch went from hit to unhit or back only count towards the
+totals, whatever happened to their hit counts.'''
+
+import cgi
+import json
+import sys
+from ccov import CoverageData, FileCoverageDetails
+from make_ui import format_line_ranges, write_report_page
+
+def _hit_functions(data):
+    return set(name for name, _, count in data.functions() if count > 0)
+
+def _hit_branches(data):
+    return set((line, block, target)
+        for line, block, target, count in data.branch_hits() if count > 0)
+
+KEYS = ['lines', 'lines-hit', 'funcs', 'funcs-hit', 'branches', 'branches-hit']
+
+def file_delta(name, before, after):
+    '''Returns the delta of one file as a dict, or None if the file's coverage
+    did not change. Either side may be None if the file is absent in that
+    run.'''
+    empty = FileCoverageDetails()
+    before = before or empty
+    after = after or empty
+    covered, uncovered = after.line_hit_changes(before)
+    oldfuncs, newfuncs = _hit_functions(before), _hit_functions(after)
+    if not covered and not uncovered and oldfuncs == newfuncs and \
+            _hit_branches(before) == _hit_branches(after):
+        return None
+    oldcounts, newcounts = before.summary(), after.summary()
+    delta = {'name': name,
+             'covered-lines': covered, 'uncovered-lines': uncovered,
+             'covered-funcs': sorted(newfuncs - oldfuncs),
+             'uncovered-funcs': sorted(oldfuncs - newfuncs)}
+    for key, old, new in zip(KEYS, oldcounts, newcounts):
+        delta[key] = [old, new]
+    return delta
+
+def _weight(delta):
+    # Files with the largest change in covered lines sort first.
+    return (-abs(delta['lines-hit'][1] - delta['lines-hit'][0]),
+        -(len(delta['covered-lines']) + len(delta['uncovered-lines'])),
+        delta['name'])
+
+def compute_delta(before, after, test=None):
+    '''Returns the delta report between two CoverageData objects as a
+    JSON-compatible dict, with the files sorted by decreasing change.'''
+    if test is None:
+        olddata, newdata = before.getFlatData(), after.getFlatData()
+    else:
+        olddata = before.getTestData(test) if test in before.getTests() else {}
+        newdata = after.getTestData(test) if test in after.getTests() else {}
+    report = {'files': []}
+    for key in KEYS:
+        report[key] = [0, 0]
+    for name in set(olddata) | set(newdata):
+        delta = file_delta(name, olddata.get(name), newdata.get(name))
+        if delta is None:
+            # Still account for the file in the totals. It may be missing
+            # from one run if it has no data at all, as with LF:0 records.
+            for side, data in enumerate((olddata, newdata)):
+                if name in data:
+                    for key, count in zip(KEYS, data[name].summary()):
+                        report[key][side] += count
+            continue
+        for key in KEYS:
+            report[key][0] += delta[key][0]
+            report[key][1] += delta[key][1]
+        report['files'].append(delta)
+    report['files'].sort(key=_weight)
+    return report
+
+def _change(pair):
+    return '%d -> %d (%+d)' % (pair[0], pair[1], pair[1] - pair[0])
+
+def write_summary(report, fd, limit=None):
+    files = report['files']
+    if limit is not None:
+        files = files[:limit]
+    for delta in files:
+        fd.write('%s: lines hit %s, functions hit %s, branches hit %s\n' % (
+            delta['name'], _change(delta['lines-hit']),
+            _change(delta['funcs-hit']), _change(delta['branches-hit'])))
+        if delta['covered-lines']:
+            fd.write('  newly covered: %s\n' %
+                format_line_ranges(delta['covered-lines']))
+        if delta['uncovered-lines']:
+            fd.write('  newly uncovered: %s\n' %
+                format_line_ranges(delta['uncovered-lines']))
+    fd.write('Total: %d files changed; lines hit %s, functions hit %s, '
+        'branches hit %s\n' % (len(report['files']),
+        _change(report['lines-hit']), _change(report['funcs-hit']),
+        _change(report['branches-hit'])))
+
+def write_html(report, fd, limit=None):
+    def cell(pair):
+        change = pair[1] - pair[0]
+        clazz = change > 0 and 'highcov' or change < 0 and 'lowcov' or ''
+        return '<td>%d</td><td>%d</td><td class="%s">%+d</td>' % (
+            pair[0], pair[1], clazz, change)
+
+    def row(name, delta, covered, uncovered):
+        return ('<tr><td>%s</td>%s%s%s<td class="highcov">%s</td>'
+            '<td class="lowcov">%s</td></tr>\n') % (name,
+            cell(delta['lines-hit']), cell(delta['funcs-hit']),
+            cell(delta['branches-hit']), covered, uncovered)
+
+    files = report['files']
+    if limit is not None:
+        files = files[:limit]
+    write_report_page(fd, 'delta.html',
+        (row(cgi.escape(delta['name']), delta,
+            format_line_ranges(delta['covered-lines']),
+            format_line_ranges(delta['uncovered-lines'])) for delta in files),
+        row('Total', report, '', ''))
+
+def _load(lcovfiles):
+    coverage = CoverageData()
+    for lcovfile in lcovfiles:
+        coverage.addFromLcovFile(open(lcovfile, 'r'))
+    return coverage
+
+def main(argv):
+    from optparse import OptionParser
+    o = OptionParser(usage="%prog [options] -b OLD.info -a NEW.info")
+    o.add_option('-b', '--before', dest="before", action="append",
+        help="Add coverage data of the earlier run", metavar="FILE")
+    o.add_option('-a', '--after', dest="after", action="append",
+        help="Add coverage data of the later run", metavar="FILE")
+    o.add_option('-t', '--test-name', dest="testname",
+        help="Only compare the data of test NAME", metavar="NAME")
+    o.add_option('-n', '--limit', dest="limit", type="int",
+        help="Only list the NUM files that changed most", metavar="NUM")
+    o.add_option('--json', dest="jsonfile",
+        help="Write the report as JSON to FILE", metavar="FILE")
+    o.add_option('--html', dest="htmlfile",
+        help="Write the report as HTML to FILE", metavar="FILE")
+    (opts, args) = o.parse_args(argv)
+    if not opts.before or not opts.after:
+        o.error("Need coverage data for both runs")
+
+    report = compute_delta(_load(opts.before), _load(opts.after),
+        opts.testname)
+    write_summary(report, sys.stdout, opts.limit)
+    if opts.jsonfile is not None:
+        with open(opts.jsonfile, 'w') as fd:
+            json.dump(report, fd)
+    if opts.htmlfile is not None:
+        with open(opts.htmlfile, 'w') as fd:
+            write_html(report, fd, opts.limit)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
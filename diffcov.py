@@ -0,0 +1,245 @@
+#!/usr/bin/python
+
+'''Coverage of the lines changed by a patch.
+
+Rather than loading entire lcov files, this scans them for their TN:/SF: lines
+(optionally caching the offsets in an index file) and only parses the records
+of files that the patch touches.'''
+
+import bisect
+import cgi
+import json
+import os
+import re
+import sys
+from ccov import CoverageData, FileCoverageDetails, lcov_record_index
+from make_ui import format_line_ranges, write_report_page
+
+class LineIntervals(object):
+    '''A sorted set of disjoint [start, end] line ranges.'''
+    def __init__(self, lines=()):
+        self._starts = []
+        self._ends = []
+        for line in sorted(set(lines)):
+            if self._ends and self._ends[-1] + 1 == line:
+                self._ends[-1] = line
+            else:
+                self._starts.append(line)
+                self._ends.append(line)
+
+    def __contains__(self, line):
+        i = bisect.bisect_right(self._starts, line) - 1
+        return i >= 0 and line <= self._ends[i]
+
+    def __len__(self):
+        return sum(end - start + 1
+            for start, end in zip(self._starts, self._ends))
+
+    def ranges(self):
+        '''Returns an iterator over (first line, last line) of each range.'''
+        return zip(self._starts, self._ends)
+
+hunkRe = re.compile(
+    r'^@@ -[0-9]+(?:,([0-9]+))? \+([0-9]+)(?:,([0-9]+))? @@')
+
+def parse_unified_diff(fd, strip=1):
+    '''Returns a map of [path -> LineIntervals] of the lines added or modified
+    by the unified diff, numbered as in the new version of each file. strip
+    leading path components are removed from the paths, as for patch -p.'''
+    changed = {}
+    filename = None
+    lineno = 0
+    # Lines of the current hunk left to read in the old and new versions.
+    # File headers are only looked for outside of hunks, as an added line
+    # may itself start with ++.
+    oldleft = newleft = 0
+    for line in fd:
+        if oldleft > 0 or newleft > 0:
+            if line.startswith('+'):
+                if filename is not None:
+                    changed[filename].append(lineno)
+                lineno += 1
+                newleft -= 1
+            elif line.startswith('-'):
+                oldleft -= 1
+            elif line.startswith('\\'):
+                # \ No newline at end of file
+                pass
+            else:
+                lineno += 1
+                oldleft -= 1
+                newleft -= 1
+            continue
+        if line.startswith('+++ '):
+            path = line[4:].rstrip('\n').split('\t')[0]
+            if path == '/dev/null':
+                filename = None
+            else:
+                filename = '/'.join(path.split('/')[strip:])
+                changed.setdefault(filename, [])
+            continue
+        if line.startswith('--- ') or line.startswith('diff '):
+            continue
+        match = hunkRe.match(line)
+        if match is not None:
+            oldcount, lineno, newcount = match.groups()
+            lineno = int(lineno)
+            oldleft = int(oldcount) if oldcount is not None else 1
+            newleft = int(newcount) if newcount is not None else 1
+    return dict((f, LineIntervals(lines)) for f, lines in changed.iteritems()
+        if lines)
+
+def load_record_index(lcovfile, indexfile=None):
+    '''Like lcov_record_index, but reuses indexfile if it is newer than the
+    lcov file and writes it out otherwise.'''
+    if indexfile is not None and os.path.exists(indexfile) and \
+            os.path.getmtime(indexfile) >= os.path.getmtime(lcovfile):
+        with open(indexfile, 'r') as fd:
+            return [tuple(entry) for entry in json.load(fd)]
+    index = lcov_record_index(lcovfile)
+    if indexfile is not None:
+        with open(indexfile, 'w') as fd:
+            json.dump(index, fd)
+    return index
+
+def match_source_file(sourcefile, changed, srcdir=None):
+    '''Returns the key of changed corresponding to the lcov source file, or
+    None if the patch does not touch it.'''
+    if srcdir is not None:
+        relpath = os.path.relpath(sourcefile, srcdir)
+        return relpath if relpath in changed else None
+    for path in changed:
+        if sourcefile == path or sourcefile.endswith('/' + path):
+            return path
+    return None
+
+def load_changed_files(lcovfiles, changed, srcdir=None, indexdir=None):
+    '''Returns a map of [path -> FileCoverageDetails] with the coverage of all
+    tests merged, reading only the records for files in changed.'''
+    coverage = {}
+    for lcovfile in lcovfiles:
+        indexfile = None
+        if indexdir is not None:
+            indexfile = os.path.join(indexdir,
+                os.path.basename(lcovfile) + '.sfidx')
+        index = load_record_index(lcovfile, indexfile)
+        with open(lcovfile, 'r') as fd:
+            for test, sourcefile, offset in index:
+                path = match_source_file(sourcefile, changed, srcdir)
+                if path is None:
+                    continue
+                CoverageData.readLcovRecord(fd, offset,
+                    coverage.setdefault(path, FileCoverageDetails()))
+    return coverage
+
+def build_report(changed, coverage):
+    '''Returns the diff coverage report as a JSON-compatible dictionary.'''
+    report = {'files': [], 'lines': 0, 'lines-hit': 0, 'branches': 0,
+              'branches-hit': 0}
+    for path in sorted(changed):
+        intervals = changed[path]
+        filedata = {'name': path, 'changed': len(intervals), 'lines': 0,
+                    'lines-hit': 0, 'branches': 0, 'branches-hit': 0,
+                    'uncovered': []}
+        details = coverage.get(path)
+        if details is not None:
+            # Only the changed ranges are looked up, not the whole file.
+            for first, last in intervals.ranges():
+                for line, count in details.lines_in_range(first, last):
+                    filedata['lines'] += 1
+                    if count > 0:
+                        filedata['lines-hit'] += 1
+                    else:
+                        filedata['uncovered'].append(line)
+                for _, _, _, count in details.branch_hits_in_range(first,
+                        last):
+                    filedata['branches'] += 1
+                    filedata['branches-hit'] += count != 0
+        for key in ['lines', 'lines-hit', 'branches', 'branches-hit']:
+            report[key] += filedata[key]
+        report['files'].append(filedata)
+    return report
+
+def _ratio(hit, count):
+    if count == 0:
+        return '-'
+    return '%.1f%%' % (100.0 * hit / count)
+
+def _coverage_class(hit, count):
+    if count == 0:
+        return ''
+    ratio = 100.0 * hit / count
+    if ratio < 75.0: return 'lowcov'
+    elif ratio < 90.0: return 'mediumcov'
+    return 'highcov'
+
+def write_summary(report, fd):
+    for filedata in report['files']:
+        fd.write('%s: %d/%d lines (%s), %d/%d branches (%s)\n' % (
+            filedata['name'], filedata['lines-hit'], filedata['lines'],
+            _ratio(filedata['lines-hit'], filedata['lines']),
+            filedata['branches-hit'], filedata['branches'],
+            _ratio(filedata['branches-hit'], filedata['branches'])))
+        if filedata['uncovered']:
+            fd.write('  uncovered: %s\n' %
+                format_line_ranges(filedata['uncovered']))
+    fd.write('Total: %d/%d lines (%s), %d/%d branches (%s)\n' % (
+        report['lines-hit'], report['lines'],
+        _ratio(report['lines-hit'], report['lines']),
+        report['branches-hit'], report['branches'],
+        _ratio(report['branches-hit'], report['branches'])))
+
+def write_html(report, fd):
+    def row(name, data, uncovered):
+        output = '<tr><td>%s</td>' % name
+        for piece in ['lines', 'branches']:
+            hit, count = data[piece + '-hit'], data[piece]
+            clazz = _coverage_class(hit, count)
+            output += '<td class="%s">%d / %d</td><td class="%s">%s</td>' % (
+                clazz, hit, count, clazz, _ratio(hit, count))
+        return output + '<td>%s</td></tr>\n' % uncovered
+
+    write_report_page(fd, 'diff.html',
+        (row(cgi.escape(f['name']), f,
+            format_line_ranges(f['uncovered'])) for f in report['files']),
+        row('Total', report, ''))
+
+def main(argv):
+    from optparse import OptionParser
+    o = OptionParser(usage="%prog -d PATCH [options] LCOVFILE...")
+    o.add_option('-d', '--diff', dest="diff",
+        help="Unified diff of the change to report on", metavar="FILE")
+    o.add_option('-p', '--strip', dest="strip", type="int", default=1,
+        help="Strip NUM leading components from paths in the diff",
+        metavar="NUM")
+    o.add_option('-s', '--source-dir', dest="srcdir",
+        help="Directory the diff paths are relative to; if not given, paths "
+             "are matched against the end of the lcov paths",
+        metavar="DIRECTORY")
+    o.add_option('--index-dir', dest="indexdir",
+        help="Cache lcov record offsets in DIRECTORY to avoid rescanning",
+        metavar="DIRECTORY")
+    o.add_option('--json', dest="jsonfile",
+        help="Write the report as JSON to FILE", metavar="FILE")
+    o.add_option('--html', dest="htmlfile",
+        help="Write the report as HTML to FILE", metavar="FILE")
+    (opts, args) = o.parse_args(argv)
+    if opts.diff is None or not args:
+        o.error("Need a diff and at least one lcov file")
+
+    with open(opts.diff, 'r') as fd:
+        changed = parse_unified_diff(fd, opts.strip)
+    srcdir = opts.srcdir and os.path.abspath(opts.srcdir)
+    coverage = load_changed_files(args, changed, srcdir, opts.indexdir)
+    report = build_report(changed, coverage)
+
+    write_summary(report, sys.stdout)
+    if opts.jsonfile is not None:
+        with open(opts.jsonfile, 'w') as fd:
+            json.dump(report, fd)
+    if opts.htmlfile is not None:
+        with open(opts.htmlfile, 'w') as fd:
+            write_html(report, fd)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
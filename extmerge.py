@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+'''Out-of-core merging of lcov files.
+
+Records of the input files are buffered as text until the buffer reaches the
+memory limit, at which point the buffer is sorted by (source file, test name)
+and spilled to a temporary run file, which is itself an lcov file. The runs
+are then k-way merged, so only the records of one (source file, test name)
+pair are ever parsed into a FileCoverageDetails at a time. At most
+merge_width runs are open at once: with more runs than that, groups of them
+are first merged into longer runs, in as many passes as needed.'''
+
+import fnmatch
+import heapq
+import metrics
+import os
+import shutil
+import sys
+import tempfile
+from ccov import CoverageData, FileCoverageDetails, NameTable, PathResolver
+from metrics import peak_rss
+
+def read_lcov_records(fd):
+    '''Yields ((source file, test name), lines) for each record of an lcov
+    file, where lines are the raw lines of the record after its SF: line, up
+    to and including end_of_record.'''
+    test = ''
+    for line in fd:
+        if line.startswith('TN:'):
+            test = line[3:].rstrip('\r\n')
+        elif line.startswith('SF:'):
+            sourcefile = line[3:].rstrip('\r\n')
+            body = []
+            for line in fd:
+                body.append(line)
+                if line.startswith('end_of_record'):
+                    break
+            yield (sourcefile, test), body
+        elif line.strip():
+            raise Exception("Unknown line: %s" % line.strip())
+
+# Size of the (key, body) and (source file, test name) tuples of a buffered
+# record, and of its slot in the buffer list.
+_RECORD_OVERHEAD = 2 * sys.getsizeof((None, None)) + sys.getsizeof([None]) - \
+    sys.getsizeof([])
+
+class ExternalMerger(object):
+    '''Merges lcov files while keeping at most memory_limit bytes of
+    buffered records in memory. Each record is buffered as a single string
+    and counted with its object overhead.'''
+    def __init__(self, memory_limit=256 << 20, glob=None, tmpdir=None,
+                 paths=None, merge_width=64):
+        self.memory_limit = memory_limit
+        self.merge_width = max(2, merge_width)
+        self.glob = glob
+        self.paths = paths if paths is not None else PathResolver()
+        self._tmpdir = tempfile.mkdtemp('ccovmerge', dir=tmpdir)
+        self._runs = []
+        self._runno = 0
+        self._buffer = []
+        self._buffered = 0
+        self.peak_buffered = 0
+        self.spilled_runs = 0
+        self.merge_passes = 0
+
+    def addFromLcovFile(self, fd):
+        for key, body in read_lcov_records(fd):
+            metrics.count('lcov-records')
+            key = (self.paths.resolve(key[0]), key[1])
+            if self.glob is not None and not fnmatch.fnmatch(key[0], self.glob):
+                continue
+            body = ''.join(body)
+            self._buffer.append((key, body))
+            self._buffered += sys.getsizeof(body) + \
+                sys.getsizeof(key[0]) + _RECORD_OVERHEAD
+            if self._buffered >= self.memory_limit:
+                self._spill()
+        fd.close()
+
+    def _spill(self):
+        if not self._buffer:
+            return
+        self.peak_buffered = max(self.peak_buffered, self._buffered)
+        # Only sort by key: records of the same key keep their input order.
+        self._buffer.sort(key=lambda record: record[0])
+        self.spilled_runs += 1
+        with open(self._newRunFile(), 'w') as fd:
+            for (sourcefile, test), body in self._buffer:
+                fd.write('TN:%s\nSF:%s\n' % (test, sourcefile))
+                fd.write(body)
+        self._buffer = []
+        self._buffered = 0
+
+    def _newRunFile(self):
+        runfile = os.path.join(self._tmpdir, 'run%d.info' % self._runno)
+        self._runno += 1
+        self._runs.append(runfile)
+        return runfile
+
+    def _iter_run(self, runfile, runno):
+        with open(runfile, 'r') as fd:
+            for key, body in read_lcov_records(fd):
+                yield key, runno, body
+
+    def _merge_runs(self, runfiles):
+        # Records of the same key keep the order of the runs they come from.
+        return heapq.merge(*[self._iter_run(runfile, runno)
+            for runno, runfile in enumerate(runfiles)])
+
+    def _reduce_runs(self):
+        # Merges groups of merge_width runs, without parsing their records,
+        # until all of the runs can be opened at once.
+        while len(self._runs) > self.merge_width:
+            runs, self._runs = self._runs, []
+            for start in range(0, len(runs), self.merge_width):
+                group = runs[start:start + self.merge_width]
+                if len(group) == 1:
+                    self._runs.extend(group)
+                    continue
+                with open(self._newRunFile(), 'w') as fd:
+                    for (sourcefile, test), _, body in self._merge_runs(group):
+                        fd.write('TN:%s\nSF:%s\n' % (test, sourcefile))
+                        fd.writelines(body)
+                for runfile in group:
+                    os.remove(runfile)
+            self.merge_passes += 1
+
+    def writeLcovOutput(self, fd):
+        '''Merges all of the data and writes it to fd in lcov format, sorted by
+        source file and then test name.'''
+        self._spill()
+        self._reduce_runs()
+        current, details = None, None
+        for key, _, body in self._merge_runs(self._runs):
+            if key != current:
+                if details is not None:
+                    self._write_record(fd, current, details)
+                # A fresh name table per file keeps memory bounded.
+                current, details = key, FileCoverageDetails(NameTable())
+            CoverageData._addLcovData(iter(body), details)
+        if details is not None:
+            self._write_record(fd, current, details)
+        fd.close()
+
+    def _write_record(self, fd, key, details):
+        fd.write('TN:%s\n' % key[1])
+        fd.write('SF:%s\n' % key[0])
+        details.write_lcov_output(fd)
+
+    def report(self, fd):
+        fd.write("External merge: %d runs, %d extra merge passes, peak buffer "
+            "%.1f MB (limit %.1f MB), peak RSS %.1f MB\n" % (self.spilled_runs,
+            self.merge_passes,
+            self.peak_buffered / 1048576.0, self.memory_limit / 1048576.0,
+            peak_rss() / 1048576.0))
+
+    def close(self):
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
@@ -1,6 +1,5 @@
 #!/usr/bin/python
 
-import os
 import struct
 import sys
 
@@ -97,10 +96,9 @@ class GcnoData(object):
         self._functions = dict()
 
     def add_to_coverage(self, covdata, testname, basepath):
+        resolve = covdata.paths.resolve
         def get_file_data(f):
-            if not os.path.isabs(f):
-                f = os.path.normpath(os.path.join(basepath, f))
-            f = os.path.realpath(f)
+            f = resolve(f, basepath, covdata.paths.RESOLVE_ALL)
             return covdata.get_or_add_file(f, testname)
 
         for function in self._functions.itervalues():
@@ -0,0 +1,164 @@
+#!/usr/bin/python
+
+'''The largest uncovered parts of the tree.
+
+Ranks the longest runs of uncovered lines, the largest uncovered functions
+and the directories with the most uncovered lines, for all tests merged or for
+each test on its own. Only the K largest entries of each ranking are kept, in
+heaps, and files that cannot hold an entry larger than the smallest one kept
+are skipped without looking at their runs or functions.'''
+
+import bisect
+import heapq
+import itertools
+import json
+import operator
+import sys
+from ccov import CoverageData
+
+class TopK(object):
+    '''Keeps the k largest of the (size, ...) tuples added to it.'''
+    def __init__(self, k):
+        self.k = k
+        self._heap = []
+
+    def threshold(self):
+        '''Returns the size an entry must exceed to be kept, or -1 while
+        fewer than k entries are kept.'''
+        return self._heap[0][0] if len(self._heap) >= self.k else -1
+
+    def add(self, entry):
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif entry > self._heap[0]:
+            heapq.heapreplace(self._heap, entry)
+
+    def largest(self):
+        return sorted(self._heap, reverse=True)
+
+def function_sizes(details, uncovered_only=False):
+    '''Yields (name, line, hit count, lines) for every function of the file
+    whose line is known, where lines is the number of lines with data from the
+    function's line up to the next function's.'''
+    functions = sorted((line, name, count)
+        for name, line, count in details.functions() if line is not None)
+    present = list(itertools.imap(operator.itemgetter(0), details.lines()))
+    starts = sorted(set(line for line, _, _ in functions))
+    for line, name, count in functions:
+        if uncovered_only and count != 0:
+            continue
+        index = bisect.bisect_right(starts, line)
+        end = starts[index] if index < len(starts) else sys.maxint
+        yield (name, line, count,
+            bisect.bisect_left(present, end) - bisect.bisect_left(present, line))
+
+def _directory(path, depth):
+    parts = path.split('/')[:-1]
+    if parts and parts[0] == '':
+        # Keep the leading / of absolute paths.
+        depth += 1
+    return '/'.join(parts[:depth]) or '.'
+
+def rank_hotspots(files, k=20, depth=None, prefix=''):
+    '''Returns the hot spot report of a map of [file -> FileCoverageDetails]
+    as a JSON-compatible dict: the k longest uncovered runs, the k largest
+    uncovered functions and the k directories with the most uncovered lines.
+    Directories are cut off after depth components, or are the files' own
+    directories if depth is None.'''
+    runs, functions = TopK(k), TopK(k)
+    # Map of [directory -> [uncovered lines, uncovered functions]]
+    directories = {}
+    for name in sorted(files):
+        if not name.startswith(prefix):
+            continue
+        details = files[name]
+        missed = details.uncovered_line_count()
+        directory = _directory(name, depth if depth is not None else
+            name.count('/'))
+        totals = directories.setdefault(directory, [0, 0])
+        totals[0] += missed
+        # No run can be longer than the file's uncovered lines.
+        if missed > runs.threshold():
+            for first, last, lines in details.uncovered_runs():
+                if lines > runs.threshold():
+                    runs.add((lines, name, first, last))
+        uncovered = sum(1 for _, _, count in details.functions() if count == 0)
+        totals[1] += uncovered
+        if uncovered:
+            for function, line, _, lines in function_sizes(details, True):
+                functions.add((lines, name, function, line))
+    return {
+        'runs': [{'file': name, 'first': first, 'last': last, 'lines': lines}
+            for lines, name, first, last in runs.largest()],
+        'functions': [{'file': name, 'function': function, 'line': line,
+            'lines': lines}
+            for lines, name, function, line in functions.largest()],
+        'directories': [{'directory': directory, 'lines': lines,
+            'functions': funcs}
+            for lines, funcs, directory in heapq.nlargest(k,
+                ((lines, funcs, directory) for directory, (lines, funcs)
+                 in directories.iteritems() if lines or funcs))],
+    }
+
+def write_summary(report, fd):
+    fd.write('Longest uncovered runs:\n')
+    for run in report['runs']:
+        fd.write('  %6d lines  %s:%d-%d\n' % (run['lines'], run['file'],
+            run['first'], run['last']))
+    fd.write('Largest uncovered functions:\n')
+    for func in report['functions']:
+        fd.write('  %6d lines  %s:%s: %s\n' % (func['lines'], func['file'],
+            func['line'], func['function']))
+    fd.write('Directories with the most uncovered lines:\n')
+    for directory in report['directories']:
+        fd.write('  %6d lines  %s (%d uncovered functions)\n' % (
+            directory['lines'], directory['directory'],
+            directory['functions']))
+
+def main(argv):
+    from optparse import OptionParser
+    o = OptionParser(usage="%prog [options] LCOVFILE...")
+    o.add_option('-n', '--limit', dest="limit", type="int", default=20,
+        help="List the NUM largest entries of each ranking", metavar="NUM")
+    o.add_option('-t', '--test-name', dest="testname",
+        help="Only rank the data of test NAME", metavar="NAME")
+    o.add_option('--each-test', dest="each_test", action="store_true",
+        default=False, help="Rank the data of every test separately")
+    o.add_option('--depth', dest="depth", type="int",
+        help="Group files by the first NUM components of their path instead "
+             "of their own directory", metavar="NUM")
+    o.add_option('--prefix', dest="prefix", default='',
+        help="Only consider files whose path starts with PREFIX",
+        metavar="PREFIX")
+    o.add_option('--json', dest="jsonfile",
+        help="Write the report as JSON to FILE", metavar="FILE")
+    (opts, args) = o.parse_args(argv)
+    if not args:
+        o.error("Need at least one lcov file")
+
+    coverage = CoverageData()
+    for lcovfile in args:
+        coverage.addFromLcovFile(open(lcovfile, 'r'))
+    rank = lambda files: rank_hotspots(files, opts.limit, opts.depth,
+        opts.prefix)
+    if opts.each_test:
+        report = {'tests': dict((test, rank(coverage.getTestData(test)))
+            for test in coverage.getTests() if coverage.getTestData(test))}
+        for test in sorted(report['tests']):
+            sys.stdout.write('== %s ==\n' % test)
+            write_summary(report['tests'][test], sys.stdout)
+    else:
+        if opts.testname is not None:
+            if opts.testname not in coverage.getTests():
+                o.error("No test named %s" % opts.testname)
+            files = coverage.getTestData(opts.testname)
+        else:
+            files = coverage.getFlatData()
+        report = rank(files)
+        write_summary(report, sys.stdout)
+    if opts.jsonfile is not None:
+        with open(opts.jsonfile, 'w') as fd:
+            json.dump(report, fd)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+
+'''Merging of lcov data while the tests producing it are still running.
+
+A reader thread splits the incoming lcov text into records at end_of_record
+boundaries and queues them; the main thread merges each record into a live
+CoverageData as it arrives and periodically writes a snapshot of the merged
+data, so that aggregation overlaps with the test run instead of following it.
+
+Data can be read from standard input, from a named pipe, or from a directory
+in which lcov files (*.info) are created and appended to. Files in a directory
+are tailed: only complete records are read, and the rest of a file is picked
+up once it has been written. A file that shrinks is taken to have been
+rewritten and is read again from the start; the records already merged from
+it cannot be taken out again, so they stay in the output.'''
+
+import fnmatch
+import os
+import Queue
+import sys
+import threading
+import time
+import metrics
+from ccov import CoverageData
+
+class LcovRecordSplitter(object):
+    '''Groups the lines of an lcov stream into (test, source file, lines)
+    records, where lines are those after the SF: line up to and including
+    end_of_record.'''
+    def __init__(self):
+        self.test = ''
+        self._sourcefile = None
+        self._body = None
+
+    def feed(self, line):
+        '''Adds a line of the stream, returning the record it completes, if
+        any.'''
+        if self._body is not None:
+            self._body.append(line)
+            if line.startswith('end_of_record'):
+                record = (self.test, self._sourcefile, self._body)
+                self._sourcefile = self._body = None
+                return record
+        elif line.startswith('TN:'):
+            self.test = line[3:].rstrip('\r\n')
+        elif line.startswith('SF:'):
+            self._sourcefile = line[3:].rstrip('\r\n')
+            self._body = []
+        elif line.strip():
+            raise Exception("Unknown line: %s" % line.strip())
+        return None
+
+def read_stream(fd, records):
+    '''Queues the records of fd as they are read, followed by None at the end
+    of the stream.'''
+    splitter = LcovRecordSplitter()
+    try:
+        for line in iter(fd.readline, ''):
+            record = splitter.feed(line)
+            if record is not None:
+                records.put(record)
+    finally:
+        records.put(None)
+
+def read_source(source, records):
+    '''Queues the records of source, which is '-' for standard input or the
+    name of a file or named pipe. The source is opened here, as opening a pipe
+    blocks until it has a writer.'''
+    try:
+        fd = sys.stdin if source == '-' else open(source, 'r')
+    except:
+        records.put(None)
+        raise
+    read_stream(fd, records)
+
+def watch_directory(dirname, records, stop, interval=1.0):
+    '''Queues the records of the *.info files of dirname as they are written,
+    until stop is set. A file that gets shorter than the offset read up to
+    was truncated or replaced, and is read again from its start.'''
+    # Map of [filename -> (offset read up to, LcovRecordSplitter)]
+    files = {}
+    while not stop.is_set():
+        for name in sorted(os.listdir(dirname)):
+            path = os.path.join(dirname, name)
+            if not name.endswith('.info') or not os.path.isfile(path):
+                continue
+            offset, splitter = files.get(name, (0, None))
+            size = os.path.getsize(path)
+            if size < offset:
+                print >> sys.stderr, "%s was rewritten, reading it again" % \
+                    path
+                offset, splitter = 0, None
+            if size <= offset:
+                continue
+            if splitter is None:
+                splitter = LcovRecordSplitter()
+            with open(path, 'r') as fd:
+                fd.seek(offset)
+                data = fd.read()
+            # Leave a partially written last line for the next round.
+            end = data.rfind('\n') + 1
+            for line in data[:end].splitlines(True):
+                record = splitter.feed(line)
+                if record is not None:
+                    records.put(record)
+            files[name] = (offset + end, splitter)
+        stop.wait(interval)
+
+class StreamingMerger(object):
+    '''Merges lcov records from a source into a CoverageData, writing the
+    merged data to outfile every flush_interval seconds when it changed.'''
+    def __init__(self, outfile, flush_interval=30.0, glob=None,
+                 coverage=None):
+        self.outfile = outfile
+        self.flush_interval = flush_interval
+        self.glob = glob
+        self.coverage = coverage if coverage is not None else CoverageData()
+        self.records = 0
+        self.flushes = 0
+
+    def run(self, source, idle_timeout=None, poll_interval=1.0):
+        '''Reads source, which is '-' for standard input, a named pipe or a
+        directory, until its end (or until idle_timeout seconds pass without
+        new records), then writes the final output. Pipes end when their last
+        writer closes them; directories are watched until interrupted.'''
+        queue = Queue.Queue(maxsize=10000)
+        stop = threading.Event()
+        watching = os.path.isdir(source)
+        if watching:
+            reader = threading.Thread(target=watch_directory,
+                args=(source, queue, stop, poll_interval))
+        else:
+            reader = threading.Thread(target=read_source,
+                args=(source, queue))
+        reader.daemon = True
+        reader.start()
+
+        dirty = False
+        last_record = last_flush = time.time()
+        try:
+            while True:
+                now = time.time()
+                timeout = max(0.01, last_flush + self.flush_interval - now)
+                if idle_timeout is not None:
+                    timeout = min(timeout,
+                        max(0.01, last_record + idle_timeout - now))
+                try:
+                    record = queue.get(timeout=timeout)
+                except Queue.Empty:
+                    record = False
+                if record is None:
+                    break
+                now = time.time()
+                if record:
+                    self._merge(record)
+                    dirty = True
+                    last_record = now
+                elif idle_timeout is not None and \
+                        now - last_record >= idle_timeout:
+                    break
+                if dirty and now - last_flush >= self.flush_interval:
+                    self.flush()
+                    dirty = False
+                    last_flush = time.time()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop.set()
+        # Records already read are still merged. A directory watcher stops
+        # after its current pass, but a pipe reader may be blocked reading.
+        while True:
+            try:
+                record = queue.get(timeout=0.1)
+            except Queue.Empty:
+                if not watching or not reader.is_alive():
+                    break
+                continue
+            if record:
+                self._merge(record)
+        self.flush()
+
+    def _merge(self, record):
+        test, sourcefile, body = record
+        if self.glob is not None and not fnmatch.fnmatch(sourcefile, self.glob):
+            return
+        with metrics.phase('parse'):
+            self.coverage.addLcovRecord(test, sourcefile, iter(body))
+        self.records += 1
+
+    def flush(self):
+        '''Writes the merged data so far. The output file is replaced
+        atomically, so readers never see a partial snapshot.'''
+        tmpfile = self.outfile + '.tmp'
+        with open(tmpfile, 'w') as fd:
+            self.coverage.writeLcovOutput(fd)
+        os.rename(tmpfile, self.outfile)
+        self.flushes += 1
+
+    def report(self, fd):
+        fd.write("Streaming merge: %d records, %d snapshots written\n" % (
+            self.records, self.flushes))
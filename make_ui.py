@@ -1,11 +1,16 @@
 #!/usr/bin/python
 
+import bisect
 import cgi
+import itertools
 import json
+import metrics
 import os
 import shutil
 import sys
+import sources
 from ccov import CoverageData
+from string import Template
 
 def main(argv):
     from optparse import OptionParser
@@ -14,37 +19,177 @@ def main(argv):
         help="Directory to store all HTML files", metavar="DIRECTORY")
     o.add_option('-s', '--source-dir', dest="basedir",
         help="Base directory for source code", metavar="DIRECTORY")
+    o.add_option('--source-git-rev', dest="gitrev",
+        help="Read source code from the git repository in the source "
+             "directory at REV instead of the working tree", metavar="REV")
+    o.add_option('--source-tarball', dest="tarball",
+        help="Read source code from the tarball FILE", metavar="FILE")
+    o.add_option('--tarball-prefix', dest="tarprefix", default='',
+        help="Directory within the tarball holding the source tree",
+        metavar="PREFIX")
+    o.add_option('--source-encoding', dest="encoding", default='utf-8',
+        help="Encoding of the source code; undecodable bytes are shown as "
+             "U+FFFD", metavar="ENCODING")
+    o.add_option('--treemap-depth', dest="treemap_depth", type="int",
+        default=2, help="Number of directory levels in each piece of the "
+        "coverage.html treemap data", metavar="N")
+    o.add_option('--paged-lines', dest="paged_lines", type="int",
+        default=20000, help="Split the pages of source files longer than N "
+        "lines into chunks that are loaded as they are scrolled to (0 to "
+        "never split them)", metavar="N")
+    o.add_option('--tree-json', dest="tree_json", action="store_true",
+        default=False, help="Also write all.json and a <test>.json per test "
+        "with the whole summary tree, which coverage.html no longer uses")
+    o.add_option('--prefetch', dest="prefetch", type="int", default=8,
+        help="Number of source files to read ahead of the page being written",
+        metavar="N")
+    o.add_option('--metrics', dest="metrics_file",
+        help="Write timings, item counts and peak memory usage of the run "
+             "as JSON to FILE", metavar="FILE")
+    o.add_option('--profile', dest="profile_file",
+        help="Run under cProfile and dump the statistics to FILE",
+        metavar="FILE")
     (opts, args) = o.parse_args(argv)
     if opts.outdir is None:
         print "Need to pass in -o!"
         sys.exit(1)
+    metrics.run(lambda: buildUi(opts, args[1:]), opts.profile_file,
+        opts.metrics_file)
 
+def buildUi(opts, lcovFiles):
     # Add in all the data
     cov = CoverageData()
-    for lcovFile in args[1:]:
-        cov.addFromLcovFile(open(lcovFile, 'r'))
+    for lcovFile in lcovFiles:
+        with metrics.measure_input(lcovFile, 'lcov', 'lcov-records'):
+            with metrics.phase('parse'):
+                cov.addFromLcovFile(open(lcovFile, 'r'))
+    entries, distinct, saved = cov.deduplicate()
+    print 'Shared %d of %d test/file entries with identical data (%d KB)' % (
+        entries - distinct, entries, saved >> 10)
 
     # Make the output directory
     if not os.path.exists(opts.outdir):
         os.makedirs(opts.outdir)
 
+    if opts.tarball is not None:
+        source = sources.TarballSource(opts.tarball, opts.tarprefix)
+    elif opts.gitrev is not None:
+        source = sources.GitSource(opts.basedir or '.', opts.gitrev)
+    else:
+        # Filled in once the base directory is known.
+        source = None
+
     print ('Building UI...')
-    builder = UiBuilder(cov, opts.outdir, opts.basedir)
-    builder.makeStaticOutput()
-    builder.makeDynamicOutput()
+    builder = UiBuilder(cov, opts.outdir, opts.basedir, source=source,
+        prefetch=opts.prefetch, encoding=opts.encoding,
+        treemap_depth=opts.treemap_depth, paged_lines=opts.paged_lines,
+        tree_json=opts.tree_json)
+    try:
+        builder.makeStaticOutput()
+        builder.makeDynamicOutput()
+    finally:
+        # The source is only set once the base directory is known.
+        if builder.source is not None:
+            builder.source.close()
+    counts = metrics.recorder.counts
+    print 'Wrote %d repeated test entries of file pages as references (%d KB)' \
+        % (counts.get('file-data-refs', 0),
+           counts.get('file-data-ref-bytes', 0) >> 10)
+
+def _countLines(srcdata):
+    # The number of lines sources.iter_source_lines yields.
+    lines = srcdata.count('\n')
+    if srcdata and not srcdata.endswith('\n'):
+        lines += 1
+    return lines
+
+class PageTemplate(object):
+    '''A string.Template-style template that has been split once into its
+    static text and the parameter names between them, so that pages can be
+    written out piece by piece instead of being built as one string.'''
+    def __init__(self, text):
+        # List of (static text, parameter name or None) pairs
+        self._segments = []
+        literal = []
+        pos = 0
+        for match in Template.pattern.finditer(text):
+            literal.append(text[pos:match.start()])
+            pos = match.end()
+            if match.group('escaped') is not None:
+                literal.append(Template.delimiter)
+                continue
+            name = match.group('named') or match.group('braced')
+            if name is None:
+                raise ValueError('Invalid placeholder in template at %d' %
+                    match.start())
+            self._segments.append((''.join(literal), name))
+            literal = []
+        literal.append(text[pos:])
+        self._segments.append((''.join(literal), None))
+
+    def write(self, fd, parameters):
+        '''Write the template to fd. Parameter values may be strings or
+        iterables of strings, the latter being written as they are produced.'''
+        for literal, name in self._segments:
+            fd.write(literal)
+            if name is None:
+                continue
+            value = parameters[name]
+            if isinstance(value, basestring):
+                fd.write(value)
+            else:
+                fd.writelines(value)
+
+def format_line_ranges(lines):
+    '''Returns the line numbers as a list of ranges, such as "1-3, 7", for the
+    report pages.'''
+    ranges = []
+    for line in sorted(set(lines)):
+        if ranges and ranges[-1][1] + 1 == line:
+            ranges[-1][1] = line
+        else:
+            ranges.append([line, line])
+    return ', '.join(start == end and str(start) or '%d-%d' % (start, end)
+        for start, end in ranges)
+
+def write_report_page(fd, template, tbody, tfoot):
+    '''Writes a standalone report page, such as those of diffcov.py and
+    delta.py, from the named template in uitemplates. The page embeds
+    ccov.css; tbody is written as it is produced.'''
+    uidir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(uidir, 'uitemplates', template), 'r') as tfd:
+        page = PageTemplate(tfd.read())
+    with open(os.path.join(uidir, 'webui', 'ccov.css'), 'r') as cssfd:
+        css = cssfd.read()
+    page.write(fd, {'css': css, 'tbody': tbody, 'tfoot': tfoot})
 
 class UiBuilder(object):
-    def __init__(self, covdata, outdir, basedir):
+    def __init__(self, covdata, outdir, basedir, source=None, prefetch=8,
+                 encoding='utf-8', treemap_depth=2, paged_lines=20000,
+                 tree_json=False):
       self.data = covdata
-      self.flatdata = self.data.getFlatData()
       self.outdir = outdir
       self.uidir = os.path.dirname(__file__)
       self.basedir = basedir
       self.relsrc = None
       self.tests = ['all']
+      self.testoptions = ''
+      self.source = source
+      self.prefetch = prefetch
+      self.encoding = encoding
+      self.treemap_depth = max(1, treemap_depth)
+      self.paged_lines = paged_lines
+      self.tree_json = tree_json
+      # List of (directory, filename) of file pages left to write
+      self.filepages = []
+      self.templates = {}
+      for name in ['coverage.html', 'directory.html', 'file.html']:
+        self.templates[name] = self._readTemplate(name)
+      from datetime import date
+      self.date = date.today().isoformat()
 
     def _loadGlobalData(self):
-        json_data = self.buildJSONData(self.flatdata)
+        json_data = self.buildJSONData(self.data.getFlatData())
         # Make the root node be the lowest path where filenames diverge. This
         # generally works, assuming that things like /usr/include/ are removed
         # from the coverage files before hand.
@@ -56,6 +201,8 @@ class UiBuilder(object):
         self.relsrc = self.relsrc.replace('//', '/')
         if self.basedir is None:
             self.basedir = self.relsrc
+        if self.source is None:
+            self.source = sources.DirectorySource(self.basedir)
         return json_data
 
     def buildJSONData(self, data):
@@ -125,34 +272,165 @@ class UiBuilder(object):
 
     def makeDynamicOutput(self):
         # Dump out JSON files
-        json_data = self._loadGlobalData()
+        with metrics.phase('json'):
+            json_data = self._loadGlobalData()
+            self._loadTests()
+            if self.tree_json:
+                self._writeTreeJSON(json_data)
+            self._treemapRecord('', json_data, self._writeTreemapShard)
+        with metrics.phase('render'):
+            with open(os.path.join(self.outdir, "coverage.html"), 'w') as fd:
+                self.writeCoveragePage(fd)
+            self._makeDirectoryIndex('', json_data)
+        self._makeFilePages()
+
+    def _writeTreeJSON(self, json_data):
+        # The whole summary tree, for 'all' and every test, as the UI loaded
+        # it before the treemap was split into shards.
         json.dump(json_data, open(os.path.join(self.outdir, 'all.json'), 'w'))
         for test in self.data.getTests():
-            small_data = self.data.getTestData(test)
-            if len(small_data) == 0:
-                continue
-            self.tests.append(test)
-            test_data = self.buildJSONData(small_data)
-            json.dump(test_data,
-                open(os.path.join(self.outdir, test + '.json'), 'w'))
+            if test in self.tests:
+                json.dump(self.buildTestJSONData(test),
+                    open(os.path.join(self.outdir, test + '.json'), 'w'))
+
+    def _loadTests(self):
+        # Tests without any data are left out of the test selectors.
+        for test in self.data.getTests():
+            if len(self.data.getTestData(test)) > 0:
+                self.tests.append(test)
         self.tests.sort()
-        covtemp = self._readTemplate("coverage.html")
-        with open(os.path.join(self.outdir, "coverage.html"), 'w') as fd:
-            fd.write(covtemp.substitute({'tests':
-                '\n'.join(('<option>%s</option>' % t) for t in self.tests)}))
-        self._makeDirectoryIndex('', json_data)
+        self.testoptions = '\n'.join(
+          ('<option>%s</option>' % t) for t in self.tests)
+
+    def buildTestJSONData(self, test):
+        return self.buildJSONData(self.data.getTestData(test))
+
+    # The treemap of coverage.html is loaded one directory at a time. The shard
+    # of a directory holds its subtree down to treemap_depth levels, with the
+    # directories at the last level collapsed into single nodes, as parallel
+    # arrays: node i is named names[i], is a child of node parents[i] (the
+    # directory itself is node 0) and is a file, directory or collapsed
+    # directory according to kinds[i]. lines, funcs and branches hold the
+    # totals of each node, and hits maps 'all' and every test with coverage
+    # in the subtree to [lines hit, funcs hit, branches hit] arrays.
+    TREEMAP_FILE, TREEMAP_DIR, TREEMAP_COLLAPSED = range(3)
+
+    def buildTreemapShard(self, dirname, jsondata):
+        '''Returns the treemap shard of the directory dirname, whose node in
+        the JSON tree is jsondata.'''
+        return self._treemapShard(dirname,
+            self._treemapRecord(dirname, jsondata))
+
+    def _treemapRecord(self, path, jsondata, emit=None):
+        # Returns (JSON node, map of [test -> [lines hit, funcs hit, branches
+        # hit]], child records), where the children are cut off below
+        # treemap_depth - 1 levels and are None for a collapsed directory.
+        # emit is called with the shard of every directory in the subtree.
+        if not jsondata['files']:
+            hits = {}
+            filekey = os.path.join(self.relsrc, path)
+            for test in self.data.getTestsForFile(filekey):
+                if test in self.tests:
+                    summary = self.data.getFileData(filekey, test).summary()
+                    if summary[1] or summary[3] or summary[5]:
+                        hits[test] = summary[1::2]
+            return jsondata, hits, []
+        children = []
+        hits = {}
+        for child in sorted(jsondata['files'], key=lambda x: x['name']):
+            record = self._treemapRecord(os.path.join(path, child['name']),
+                child, emit)
+            for test, counts in record[1].iteritems():
+                total = hits.setdefault(test, [0, 0, 0])
+                for i in range(3):
+                    total[i] += counts[i]
+            children.append(self._cutTreemapRecord(record,
+                self.treemap_depth - 1))
+        record = (jsondata, hits, children)
+        if emit is not None:
+            emit(path, self._treemapShard(path, record))
+        return record
+
+    def _cutTreemapRecord(self, record, depth):
+        node, hits, children = record
+        if children is None or not node['files']:
+            return record
+        if depth == 0:
+            return node, hits, None
+        return node, hits, [self._cutTreemapRecord(child, depth - 1)
+            for child in children]
+
+    def _treemapShard(self, path, record):
+        # Nodes are numbered breadth first, as (record, parent index).
+        records = [(record, -1)]
+        index = 0
+        while index < len(records):
+            children = records[index][0][2]
+            records.extend((child, index) for child in children or ())
+            index += 1
+        kinds = []
+        for (node, _, children), _ in records:
+            if not node['files']:
+                kinds.append(self.TREEMAP_FILE)
+            elif children is None:
+                kinds.append(self.TREEMAP_COLLAPSED)
+            else:
+                kinds.append(self.TREEMAP_DIR)
+        shard = {'path': path, 'kinds': kinds,
+                 'names': [node.get('name', '') for (node, _, _), _ in records],
+                 'parents': [parent for _, parent in records]}
+        properties = ('lines', 'funcs', 'branches')
+        for prop in properties:
+            shard[prop] = [node[prop] for (node, _, _), _ in records]
+        shard['hits'] = {'all': [[node[prop + '-hit']
+            for (node, _, _), _ in records] for prop in properties]}
+        none = (0, 0, 0)
+        for test in record[1]:
+            shard['hits'][test] = [[hits.get(test, none)[i]
+                for (_, hits, _), _ in records] for i in range(3)]
+        return shard
+
+    def _writeTreemapShard(self, dirname, shard):
+        outputdir = os.path.join(self.outdir, dirname)
+        if not os.path.exists(outputdir):
+            os.makedirs(outputdir)
+        with open(os.path.join(outputdir, 'treemap.json'), 'w') as fd:
+            json.dump(shard, fd, separators=(',', ':'))
+        metrics.count('treemap-shards')
+
+    def writeCoveragePage(self, fd):
+        self.templates["coverage.html"].write(fd, {'tests': self.testoptions})
 
     def _readTemplate(self, name):
-      from string import Template
       templatefile = os.path.join(self.uidir, "uitemplates", name)
       fd = open(templatefile, 'r')
       try:
         template = fd.read()
       finally:
         fd.close()
-      return Template(template)
+      return PageTemplate(template)
 
     def _makeDirectoryIndex(self, dirname, jsondata):
+      outputdir = os.path.join(self.outdir, dirname)
+      if not os.path.exists(outputdir):
+        os.makedirs(outputdir)
+      fd = open(os.path.join(outputdir, 'index.html'), 'w')
+      try:
+        self.writeDirectoryPage(fd, dirname, jsondata)
+      finally:
+        fd.close()
+      metrics.count('directory-pages')
+
+      # Recursively build for all files in the directory
+      for child in jsondata['files']:
+        if len(child['files']) > 0:
+          self._makeDirectoryIndex(os.path.join(dirname, child['name']), child)
+        else:
+          self.filepages.append((dirname, child['name']))
+
+    def writeDirectoryPage(self, fd, dirname, jsondata):
+      '''Writes the index page of the directory dirname, whose node in the
+      JSON tree is jsondata.'''
       # Utility method for printing out rows of the table
       def summary_string(lhs, jsondata):
         output = '<tr>'
@@ -170,7 +448,7 @@ class UiBuilder(object):
             output += '<td class="%s">%d / %d</td><td class="%s">%.1f%%</td>' % (
               clazz, hit, count, clazz, ratio)
         return output + '</tr>'
-      htmltmp = self._readTemplate('directory.html')
+      htmltmp = self.templates['directory.html']
 
       jsondata['files'].sort(lambda x, y: cmp(x['name'], y['name']))
 
@@ -181,10 +459,8 @@ class UiBuilder(object):
         parameters['depth'] = '/'.join('..' for x in dirname.split('/'))
       else:
         parameters['depth'] = '.'
-      parameters['testoptions'] = '\n'.join(
-        ('<option>%s</option>' % test) for test in self.tests)
-      from datetime import date
-      parameters['date'] = date.today().isoformat()
+      parameters['testoptions'] = self.testoptions
+      parameters['date'] = self.date
 
       def htmlname(json):
         if len(json['files']) > 0:
@@ -196,55 +472,75 @@ class UiBuilder(object):
                            for child in jsondata['files'])
       parameters['tbody'] = tablestr
       parameters['tfoot'] = summary_string('Total', jsondata)
+      htmltmp.write(fd, parameters)
 
-      outputdir = os.path.join(self.outdir, dirname)
-      if not os.path.exists(outputdir):
-        os.makedirs(outputdir)
-      fd = open(os.path.join(outputdir, 'index.html'), 'w')
-      try:
-        fd.write(htmltmp.substitute(parameters))
-      finally:
-        fd.close()
-
-      # Recursively build for all files in the directory
-      for child in jsondata['files']:
-        if len(child['files']) > 0:
-          self._makeDirectoryIndex(os.path.join(dirname, child['name']), child)
-        else:
-          self._makeFileData(dirname, child['name'], child)
+    def _makeFilePages(self):
+        # Source files are read ahead on a thread pool while pages are written.
+        paths = [os.path.join(dirname, filename)
+            for dirname, filename in self.filepages]
+        pages = sources.prefetch(self.source, paths, self.prefetch)
+        while True:
+            # Time spent waiting for the source files to be read
+            with metrics.phase('source'):
+                page = next(pages, None)
+            if page is None:
+                break
+            path, srcdata = page
+            dirname, filename = os.path.split(path)
+            with metrics.phase('render'):
+                self._makeFileData(dirname, filename, srcdata)
+        self.filepages = []
 
-    def _makeFileData(self, dirname, filename, jsondata):
+    def _makeFileData(self, dirname, filename, srcdata):
         print 'Writing %s/%s.html' % (dirname, filename)
-        htmltmp = self._readTemplate('file.html')
+        outputdir = os.path.join(self.outdir, dirname)
+        if not os.path.exists(outputdir):
+            os.makedirs(outputdir)
+        with open(os.path.join(outputdir, filename + '.html'), 'w') as fd:
+            self.writeFilePage(fd, dirname, filename, srcdata)
+        metrics.count('file-pages')
+        if srcdata is not None and self.isPagedFile(srcdata):
+            chunkdir = os.path.join(outputdir, filename + '.chunks')
+            if not os.path.exists(chunkdir):
+                os.makedirs(chunkdir)
+            for index, chunk in enumerate(self.buildFileChunks(dirname,
+                    filename, srcdata)):
+                with open(os.path.join(chunkdir, '%d.json' % index), 'w') as fd:
+                    json.dump(chunk, fd, separators=(',', ':'))
+                metrics.count('file-chunks')
+
+    def writeFilePage(self, fd, dirname, filename, srcdata):
+        '''Writes the page of a source file, given the contents of the file
+        (None if it could not be read).'''
+        htmltmp = self.templates['file.html']
 
         parameters = {}
         parameters['file'] = os.path.join(dirname, filename)
         parameters['directory'] = dirname
         parameters['depth'] = '/'.join('..' for x in dirname.split('/'))
-        parameters['testoptions'] = '\n'.join(
-           '<option>%s</option>' % s for s in self.tests)
-        from datetime import date
-        parameters['date'] = date.today().isoformat()
+        parameters['testoptions'] = self.testoptions
+        parameters['date'] = self.date
 
-        # Read the input file
-        srcfile = os.path.join(self.basedir, dirname, filename)
         filekey = os.path.join(self.relsrc, dirname, filename)
-        if not os.path.exists(srcfile):
+        if srcdata is None:
             parameters['tbody'] = (
                 '<tr><td colspan="5">File could not be found</td></tr>')
             parameters['data'] = ''
+        elif self.isPagedFile(srcdata):
+            # The rows are loaded by the page; see buildFileChunks.
+            parameters['tbody'] = ''
+            with metrics.phase('json'):
+                parameters['data'] = 'var chunkIndex=%s;' % json.dumps(
+                    self._chunkIndex(filename, srcdata,
+                        self.data.getFlatFileData(filekey)))
         else:
-            with open(srcfile, 'r') as fd:
-                srclines = fd.readlines()
-
-            flatdata = self.flatdata[filekey]
-            del self.flatdata[filekey] # Scavenge memory we don't need anymore.
-            alldata = self._buildFileJson(flatdata)
-            outdata = {'all': alldata}
-            for test in self.tests[1:]:
-                outdata[test] = self._buildFileJson(
-                    self.data.getFileData(filekey, test))
-            parameters['data'] = '''var data=%s;''' % json.dumps(outdata)
+            srclines = sources.iter_source_lines(srcdata, self.encoding)
+
+            flatdata = self.data.getFlatFileData(filekey)
+            with metrics.phase('json'):
+                outdata = self._buildFileData(filekey, flatdata)
+                alldata = outdata['all']
+                parameters['data'] = '''var data=%s;''' % json.dumps(outdata)
             # Precompute branch data for each line.
             brlinedata = {}
             for line in range(len(alldata['lines'])):
@@ -264,29 +560,118 @@ class UiBuilder(object):
                     entries[i] += '<br>'
                 brlinedata[alldata['lines'][line]] = ''.join(entries)
 
-            lineno = 1
-            outlines = []
-            linehitdata = dict(flatdata.lines())
-            for line in srclines:
-                covstatus = ''
-                linecount = ''
-                if lineno in linehitdata:
-                    linecount = str(linehitdata[lineno])
-                    iscov = linecount != '0'
-                    covstatus = ' class="highcov"' if iscov else ' class="lowcov"'
-                brcount = brlinedata.get(lineno, '')
-                outlines.append(('  <tr%s><td>%d</td>' +
-                    '<td>%s</td><td>%s</td><td>%s</td></tr>\n'
-                    ) % (covstatus, lineno, brcount, linecount,
-                        cgi.escape(line.rstrip())))
-                lineno += 1
-            parameters['tbody'] = ''.join(outlines)
+            parameters['tbody'] = self._fileRows(srclines, flatdata,
+                brlinedata)
+        htmltmp.write(fd, parameters)
 
-        outputdir = os.path.join(self.outdir, dirname)
-        if not os.path.exists(outputdir):
-            os.makedirs(outputdir)
-        with open(os.path.join(outputdir, filename + '.html'), 'w') as fd:
-            fd.write(htmltmp.substitute(parameters))
+    def _buildFileData(self, filekey, flatdata):
+        # Map of [test -> file JSON] for 'all' and the tests of the file.
+        outdata = {'all': self._buildFileJson(flatdata)}
+        # Map of [id of FileCoverageDetails -> first key with that data]
+        # Tests sharing their data with 'all' or with an earlier test, after
+        # CoverageData.deduplicate, get the key of that entry instead of a
+        # copy of it.
+        keys = {id(flatdata): 'all'}
+        # Map of [key -> JSON size of its entry] for the entries referred to
+        sizes = {}
+        # Tests that never touched this file are left out entirely; the UI
+        # treats a missing entry as having no coverage.
+        for test in self.data.getTestsForFile(filekey):
+            if test in self.tests:
+                details = self.data.getFileData(filekey, test)
+                key = keys.setdefault(id(details), test)
+                if key != test:
+                    outdata[test] = key
+                    if key not in sizes:
+                        sizes[key] = len(json.dumps(outdata[key]))
+                    metrics.count('file-data-refs')
+                    metrics.count('file-data-ref-bytes', sizes[key])
+                else:
+                    outdata[test] = self._buildFileJson(details)
+        return outdata
+
+    # Number of source lines in each chunk of a paged file page.
+    LINES_PER_CHUNK = 2000
+
+    def isPagedFile(self, srcdata):
+        '''Returns whether the page of a file with the given contents is split
+        into chunks.'''
+        return self.paged_lines > 0 and _countLines(srcdata) > self.paged_lines
+
+    def _chunkIndex(self, filename, srcdata, flatdata):
+        # The number of instrumented and hit lines of every chunk lets the
+        # page show where the coverage is before loading any chunk.
+        size = self.LINES_PER_CHUNK
+        nlines = _countLines(srcdata)
+        chunks = [[0, 0] for _ in range((nlines + size - 1) // size)]
+        for line, count in flatdata.lines():
+            if 0 < line <= nlines:
+                chunk = chunks[(line - 1) // size]
+                chunk[0] += 1
+                chunk[1] += count > 0
+        return {'lines': nlines, 'size': size, 'path': filename + '.chunks',
+                'chunks': chunks}
+
+    def buildFileChunks(self, dirname, filename, srcdata):
+        '''Yields the chunks of a paged file page in order. Each holds the
+        number of its first line, its source lines and, in the format of the
+        data of unpaged pages, the coverage of those lines for 'all' and the
+        tests with coverage in them.'''
+        filekey = os.path.join(self.relsrc, dirname, filename)
+        with metrics.phase('json'):
+            filedata = self._buildFileData(filekey,
+                self.data.getFlatFileData(filekey))
+        srclines = sources.iter_source_lines(srcdata, self.encoding)
+        first = 1
+        while True:
+            source = list(itertools.islice(srclines, self.LINES_PER_CHUNK))
+            if not source:
+                break
+            end = first + len(source)
+            data = {}
+            for test, testdata in filedata.iteritems():
+                if isinstance(testdata, basestring):
+                    continue
+                lines = testdata['lines']
+                start = bisect.bisect_left(lines, first)
+                stop = bisect.bisect_left(lines, end)
+                if start < stop or test == 'all':
+                    data[test] = dict((key, testdata[key][start:stop])
+                        for key in ('lines', 'lcounts', 'bcounts'))
+            # References are kept as long as what they refer to is.
+            for test, testdata in filedata.iteritems():
+                if isinstance(testdata, basestring) and testdata in data:
+                    data[test] = testdata
+            yield {'first': first, 'source': source, 'data': data}
+            first = end
+
+    # Number of source rows to format before handing them to the output file.
+    ROW_CHUNK = 512
+
+    def _fileRows(self, srclines, filedata, brlinedata):
+        '''Yields the table rows for a source file in chunks of ROW_CHUNK
+        lines, so that the page never exists in memory as a single string.'''
+        escape = cgi.escape
+        get_line_hit = filedata.get_line_hit
+        rowfmt = '  <tr%s><td>%d</td><td>%s</td><td>%s</td><td>%s</td></tr>\n'
+        chunk = []
+        lineno = 0
+        for lineno, line in enumerate(srclines, 1):
+            covstatus = ''
+            linecount = ''
+            hits = get_line_hit(lineno)
+            if hits is not None:
+                linecount = str(hits)
+                covstatus = ' class="highcov"' if hits else ' class="lowcov"'
+            brcount = brlinedata.get(lineno, '')
+            chunk.append(rowfmt % (covstatus, lineno, brcount, linecount,
+                escape(line).encode('utf-8')))
+            if len(chunk) == self.ROW_CHUNK:
+                yield ''.join(chunk)
+                chunk = []
+        if chunk:
+            yield ''.join(chunk)
+        metrics.count('source-lines', lineno)
 
     def _buildFileJson(self, data):
         lcs = list(data.lines())
@@ -294,10 +679,8 @@ class UiBuilder(object):
             lines, counts = zip(*lcs)
         else:
             lines, counts = [],[]
-        brdata = list(data.branches())
-        brdata.sort()
         brlinedata = {}
-        for line, branchid, ids, brcounts in brdata:
+        for line, branchid, ids, brcounts in data.branches():
             brlinedata.setdefault(line, {})[branchid] = brcounts
         flat = [brlinedata.get(l, {}) for l in lines]
         return {'lines': lines, 'lcounts': counts, 'bcounts': flat}
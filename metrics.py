@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+'''Timings, counters and memory usage of a coverage run.
+
+The tools record into the module-level recorder: phases are timed with
+phase(), item counts are kept with count() and inputs are measured with
+measure_input(). Phases may nest; a phase's time excludes the time spent in
+the phases nested in it, so the phase times of a run add up to (at most) its
+total time. run() wraps a whole run, optionally under cProfile, and writes the
+recorded data as a JSON report.'''
+
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+def peak_rss():
+    '''Returns the peak resident set size of this process in bytes.'''
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X reports bytes.
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+def current_rss():
+    '''Returns the current resident set size of this process in bytes.'''
+    try:
+        with open('/proc/self/statm', 'r') as fd:
+            return int(fd.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # No procfs; the peak is the best approximation available.
+        return peak_rss()
+
+def _rate(amount, seconds):
+    if amount is None or seconds <= 0:
+        return None
+    return amount / seconds
+
+class Metrics(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        # Map of [phase name -> [seconds, calls]]
+        self.phases = {}
+        # Map of [counter name -> count]
+        self.counts = {}
+        self.inputs = []
+        # Time spent in nested phases, one entry per active phase
+        self._nested = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Times the enclosed block as part of phase name.'''
+        start = time.time()
+        self._nested.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            entry = self.phases.setdefault(name, [0.0, 0])
+            entry[0] += elapsed - nested
+            entry[1] += 1
+
+    def count(self, name, amount=1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    @contextlib.contextmanager
+    def measure_input(self, path, kind, counter=None):
+        '''Measures the throughput of reading one input. The items read are
+        the increase of counter during the enclosed block.'''
+        before = self.counts.get(counter, 0)
+        start = time.time()
+        yield
+        seconds = time.time() - start
+        size = os.path.getsize(path) if os.path.isfile(path) else None
+        items = self.counts.get(counter, 0) - before if counter else None
+        self.inputs.append({'path': path, 'kind': kind, 'seconds': seconds,
+            'bytes': size, 'items': items,
+            'bytes-per-second': _rate(size, seconds),
+            'items-per-second': _rate(items, seconds)})
+
+    def report(self):
+        '''Returns everything recorded so far as a JSON-compatible dict.'''
+        total = time.time() - self.start
+        phases = dict((name, {'seconds': seconds, 'calls': calls})
+            for name, (seconds, calls) in self.phases.iteritems())
+        return {'command': sys.argv, 'seconds': total,
+            'unaccounted-seconds': total - sum(seconds
+                for seconds, _ in self.phases.itervalues()),
+            'peak-rss': peak_rss(), 'phases': phases,
+            'counts': dict(self.counts), 'inputs': self.inputs}
+
+    def write_report(self, filename):
+        with open(filename, 'w') as fd:
+            json.dump(self.report(), fd, indent=2, sort_keys=True)
+            fd.write('\n')
+
+recorder = Metrics()
+phase = recorder.phase
+count = recorder.count
+measure_input = recorder.measure_input
+
+def run(fn, profile=None, report=None):
+    '''Calls fn() with a fresh recorder. If profile is given, fn is run under
+    cProfile and the statistics are dumped to that file, for use with pstats.
+    If report is given, the metrics are written to that file as JSON. Both are
+    written even if fn fails.'''
+    recorder.reset()
+    profiler = None
+    if profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        if profiler is not None:
+            return profiler.runcall(fn)
+        return fn()
+    finally:
+        if profiler is not None:
+            profiler.dump_stats(profile)
+        if report is not None:
+            recorder.write_report(report)
@@ -0,0 +1,233 @@
+#!/usr/bin/python
+
+'''Serve the coverage UI over HTTP, rendering pages when they are requested.
+
+make_ui.py writes a page for every directory and source file up front. This
+server instead loads the coverage data and builds the summary tree once, then
+renders the pages and JSON data of coverage.html with the same UiBuilder code
+on request. Rendered responses are kept in an LRU cache bounded in bytes.'''
+
+import BaseHTTPServer
+import cStringIO
+import collections
+import json
+import mimetypes
+import os
+import posixpath
+import sys
+import time
+import urllib
+import sources
+from ccov import CoverageData
+from make_ui import UiBuilder
+
+class PageCache(object):
+    '''An LRU map of [path -> (content type, body)] holding at most limit
+    bytes of bodies.'''
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._pages = collections.OrderedDict()
+
+    def get(self, path):
+        page = self._pages.pop(path, None)
+        if page is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._pages[path] = page
+        return page
+
+    def put(self, path, page):
+        if len(page[1]) > self.limit:
+            return
+        if path in self._pages:
+            self.size -= len(self._pages.pop(path)[1])
+        self._pages[path] = page
+        self.size += len(page[1])
+        while self.size > self.limit:
+            _, (_, body) = self._pages.popitem(last=False)
+            self.size -= len(body)
+
+class PageRenderer(object):
+    '''Renders the pages of the coverage UI from a UiBuilder, which is loaded
+    once up front.'''
+    def __init__(self, builder):
+        self.builder = builder
+        self.tree = builder._loadGlobalData()
+        builder._loadTests()
+        # Map of [directory -> JSON node] of every directory page
+        self.directories = {}
+        self._indexTree('', self.tree)
+
+    def _indexTree(self, dirname, node):
+        self.directories[dirname] = node
+        for child in node['files']:
+            if child['files']:
+                self._indexTree(posixpath.join(dirname, child['name']), child)
+
+    def render(self, path):
+        '''Returns (content type, body) for the path relative to the root of
+        the UI, or None if there is no such page.'''
+        builder = self.builder
+        fd = cStringIO.StringIO()
+        dirname, name = posixpath.split(path)
+        if name == 'index.html' and dirname in self.directories:
+            builder.writeDirectoryPage(fd, dirname, self.directories[dirname])
+        elif path == 'coverage.html':
+            builder.writeCoveragePage(fd)
+        elif name == 'treemap.json' and dirname in self.directories:
+            json.dump(builder.buildTreemapShard(dirname,
+                self.directories[dirname]), fd, separators=(',', ':'))
+        elif dirname.endswith('.chunks') and name[:-5].isdigit() and \
+                name.endswith('.json'):
+            chunk = self._fileChunk(dirname[:-7], int(name[:-5]))
+            if chunk is None:
+                return None
+            json.dump(chunk, fd, separators=(',', ':'))
+        elif name.endswith('.html') and self._isFile(dirname, name[:-5]):
+            srcdata = builder.source.read(path[:-5])
+            builder.writeFilePage(fd, dirname, name[:-5], srcdata)
+        else:
+            return self._static(path)
+        ctype = 'application/json' if name.endswith('.json') else 'text/html'
+        return ctype, fd.getvalue()
+
+    def _isFile(self, dirname, filename):
+        node = self.directories.get(dirname)
+        if node is None:
+            return False
+        return any(child['name'] == filename and not child['files']
+            for child in node['files'])
+
+    def _fileChunk(self, path, index):
+        dirname, filename = posixpath.split(path)
+        if not self._isFile(dirname, filename):
+            return None
+        srcdata = self.builder.source.read(path)
+        if srcdata is None or not self.builder.isPagedFile(srcdata):
+            return None
+        for number, chunk in enumerate(self.builder.buildFileChunks(dirname,
+                filename, srcdata)):
+            if number == index:
+                return chunk
+        return None
+
+    def _static(self, path):
+        if '/' in path:
+            return None
+        staticfile = os.path.join(self.builder.uidir, 'webui', path)
+        if not os.path.isfile(staticfile):
+            return None
+        with open(staticfile, 'rb') as fd:
+            return mimetypes.guess_type(path)[0] or 'text/plain', fd.read()
+
+    def is_directory(self, path):
+        return path.rstrip('/') in self.directories
+
+class CoverageRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        path = urllib.unquote(self.path.split('?', 1)[0]).lstrip('/')
+        if path and not path.endswith('/') and \
+                server.renderer.is_directory(path):
+            # Links to directories are relative to the directory itself.
+            self.send_response(301)
+            self.send_header('Location', '/' + path + '/')
+            self.end_headers()
+            return
+        if path.endswith('/') or path == '':
+            path += 'index.html'
+        page = server.cache.get(path)
+        if page is None:
+            page = server.renderer.render(path)
+            if page is None:
+                self.send_error(404)
+                return
+            server.cache.put(path, page)
+        self.send_response(200)
+        self.send_header('Content-Type', page[0])
+        self.send_header('Content-Length', str(len(page[1])))
+        self.end_headers()
+        self.wfile.write(page[1])
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                *args)
+
+class CoverageServer(BaseHTTPServer.HTTPServer):
+    '''Serves the pages of a PageRenderer, one request at a time.'''
+    def __init__(self, address, renderer, cache_limit=64 << 20, quiet=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+            CoverageRequestHandler)
+        self.renderer = renderer
+        self.cache = PageCache(cache_limit)
+        self.quiet = quiet
+
+def make_renderer(covdata, basedir=None, source=None, encoding='utf-8'):
+    '''Returns a PageRenderer for the coverage data.'''
+    builder = UiBuilder(covdata, None, basedir, source=source,
+        encoding=encoding)
+    return PageRenderer(builder)
+
+def main(argv):
+    from optparse import OptionParser
+    o = OptionParser(usage="%prog [options] LCOVFILE...")
+    o.add_option('-p', '--port', dest="port", type="int", default=8000,
+        help="Port to listen on", metavar="PORT")
+    o.add_option('--host', dest="host", default='localhost',
+        help="Address to listen on", metavar="HOST")
+    o.add_option('-s', '--source-dir', dest="basedir",
+        help="Base directory for source code", metavar="DIRECTORY")
+    o.add_option('--source-git-rev', dest="gitrev",
+        help="Read source code from the git repository in the source "
+             "directory at REV instead of the working tree", metavar="REV")
+    o.add_option('--source-tarball', dest="tarball",
+        help="Read source code from the tarball FILE", metavar="FILE")
+    o.add_option('--tarball-prefix', dest="tarprefix", default='',
+        help="Directory within the tarball holding the source tree",
+        metavar="PREFIX")
+    o.add_option('--source-encoding', dest="encoding", default='utf-8',
+        help="Encoding of the source code; undecodable bytes are shown as "
+             "U+FFFD", metavar="ENCODING")
+    o.add_option('--cache-size', dest="cache_size", type="int", default=64,
+        help="Keep at most MB of rendered pages in memory", metavar="MB")
+    o.add_option('-q', '--quiet', dest="quiet", action="store_true",
+        default=False, help="Do not log requests")
+    (opts, args) = o.parse_args(argv)
+    if not args:
+        o.error("Need at least one lcov file")
+
+    cov = CoverageData()
+    for lcovFile in args:
+        print >> sys.stderr, "Reading file %s" % lcovFile
+        cov.addFromLcovFile(open(lcovFile, 'r'))
+    entries, distinct, saved = cov.deduplicate()
+    print >> sys.stderr, "Shared %d of %d test/file entries (%d KB)" % (
+        entries - distinct, entries, saved >> 10)
+    if opts.tarball is not None:
+        source = sources.TarballSource(opts.tarball, opts.tarprefix)
+    elif opts.gitrev is not None:
+        source = sources.GitSource(opts.basedir or '.', opts.gitrev)
+    else:
+        source = None
+    start = time.time()
+    renderer = make_renderer(cov, opts.basedir, source, opts.encoding)
+    print >> sys.stderr, "Built the summary tree in %.1fs" % (
+        time.time() - start)
+
+    server = CoverageServer((opts.host, opts.port), renderer,
+        opts.cache_size << 20, opts.quiet)
+    print >> sys.stderr, "Serving on http://%s:%d/" % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        renderer.builder.source.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
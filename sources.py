@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+'''Providers for the source code shown on the file pages of the UI.
+
+The UI only needs the text of each source file once, in the order the pages
+are written, so providers return the raw bytes of a file and the prefetcher
+reads the next few files on worker threads while the current page is being
+written out.'''
+
+import collections
+import io
+import os
+import subprocess
+import tarfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+class SourceProvider(object):
+    '''Base class for source providers. Paths are always relative to the root
+    of the source tree.'''
+
+    def read(self, path):
+        '''Return the contents of the file as a byte string, or None if the file
+        does not exist.'''
+        raise NotImplementedError()
+
+    def close(self):
+        '''Releases the resources of the provider.'''
+        pass
+
+class DirectorySource(SourceProvider):
+    '''Reads sources from a checked-out tree on disk.'''
+    def __init__(self, basedir):
+        self.basedir = basedir
+
+    def read(self, path):
+        try:
+            with open(os.path.join(self.basedir, path), 'rb') as fd:
+                return fd.read()
+        except IOError:
+            return None
+
+class GitSource(SourceProvider):
+    '''Reads sources straight out of the object store of a git repository at a
+    given revision, so no checkout is necessary. Paths are relative to
+    repodir, which may be a subdirectory of the repository. All files are read
+    through a single git cat-file --batch process.'''
+    def __init__(self, repodir, rev='HEAD'):
+        self.repodir = repodir
+        self.rev = rev
+        self._proc = None
+        # Requests and their replies must not interleave across threads.
+        self._lock = threading.Lock()
+
+    def read(self, path):
+        if '\n' in path:
+            return None
+        with self._lock:
+            if self._proc is None:
+                with open(os.devnull, 'w') as hideOutput:
+                    self._proc = subprocess.Popen(['git', 'cat-file',
+                        '--batch'], cwd=self.repodir, stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE, stderr=hideOutput)
+            proc = self._proc
+            # A ./ path is looked up relative to repodir rather than to the
+            # root of the repository.
+            try:
+                proc.stdin.write('%s:./%s\n' % (self.rev, path))
+                proc.stdin.flush()
+            except IOError:
+                # git exited, as it does outside of a repository.
+                return None
+            line = proc.stdout.readline().rstrip('\n')
+            # The object name is echoed back in these replies, and a path may
+            # contain spaces, so only their last word can be relied on.
+            if not line or line.endswith(' missing') or \
+                    line.endswith(' ambiguous'):
+                return None
+            header = line.split(' ')
+            data = proc.stdout.read(int(header[2]))
+            proc.stdout.read(1)
+        if header[1] != 'blob':
+            return None
+        return data
+
+    def close(self):
+        with self._lock:
+            if self._proc is not None:
+                self._proc.stdin.close()
+                self._proc.wait()
+                self._proc = None
+
+class TarballSource(SourceProvider):
+    '''Reads sources out of a (possibly compressed) tarball. The prefix is
+    prepended to every path to find its member in the archive.'''
+    def __init__(self, tarpath, prefix=''):
+        self._tar = tarfile.open(tarpath, 'r:*')
+        self._members = dict((m.name, m) for m in self._tar.getmembers()
+            if m.isfile())
+        self._prefix = prefix
+        # TarFile objects share one underlying file position.
+        self._lock = threading.Lock()
+
+    def read(self, path):
+        member = self._members.get(os.path.normpath(
+            os.path.join(self._prefix, path)))
+        if member is None:
+            return None
+        with self._lock:
+            return self._tar.extractfile(member).read()
+
+    def close(self):
+        self._tar.close()
+
+def iter_source_lines(data, encoding='utf-8', errors='replace'):
+    '''Yields the lines of the file contents as unicode strings, without their
+    line terminators. Byte sequences that are not valid in the encoding are
+    handled according to errors, as for str.decode; the default replaces them
+    with U+FFFD so that a stray Latin-1 byte never aborts a page.'''
+    for line in io.BytesIO(data):
+        yield line.rstrip().decode(encoding, errors)
+
+def prefetch(provider, paths, window=8, threads=4):
+    '''Yields (path, contents) for every path, in order, while reading up to
+    window files ahead on a pool of threads. A window of 0 reads each file only
+    when it is needed.'''
+    if window <= 0:
+        for path in paths:
+            yield path, provider.read(path)
+        return
+    pool = ThreadPool(threads)
+    try:
+        pending = collections.deque()
+        paths = iter(paths)
+        for path in paths:
+            pending.append((path, pool.apply_async(provider.read, (path,))))
+            if len(pending) >= window:
+                path, result = pending.popleft()
+                yield path, result.get()
+        while pending:
+            path, result = pending.popleft()
+            yield path, result.get()
+    finally:
+        pool.terminate()
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+
+'''An inverted index from (file, line) to the tests that execute the line.
+
+For every file, the index holds the sorted array of lines hit by at least one
+test and, for each of those lines, a fixed-width bitmap of test ids. Saved
+indexes are memory-mapped, so a query only reads the header and the block of
+the file being asked about.
+
+Usage:
+  testindex.py build -o INDEX LCOVFILE...
+  testindex.py query INDEX FILE[:LINE[-LINE]]...'''
+
+import array
+import bisect
+import marshal
+import mmap
+import re
+import struct
+import sys
+from ccov import CoverageData
+
+MAGIC = 'CCTI'
+VERSION = 1
+
+class TestIndex(object):
+    def __init__(self, tests, files):
+        # tests is the list of test names, indexed by test id. files is a map
+        # of [file -> (lines array, bitmaps string)].
+        self.tests = tests
+        self._files = files
+        self._width = (len(tests) + 7) // 8
+        self._mmap = None
+
+    @classmethod
+    def build(cls, covdata):
+        '''Builds the index from the data of every test in a CoverageData.'''
+        tests = sorted(covdata.getTests())
+        linebits = {}
+        for testid, test in enumerate(tests):
+            bit = 1 << testid
+            for filename, details in covdata.getTestData(test).iteritems():
+                filebits = linebits.setdefault(filename, {})
+                for line, count in details.lines():
+                    if count > 0:
+                        filebits[line] = filebits.get(line, 0) | bit
+        width = (len(tests) + 7) // 8
+        files = {}
+        for filename, filebits in linebits.iteritems():
+            lines = array.array('l', sorted(filebits))
+            files[filename] = (lines, ''.join(
+                _pack_bitmap(filebits[line], width) for line in lines))
+        return cls(tests, files)
+
+    def _block(self, filename):
+        entry = self._files.get(filename)
+        if entry is None or self._mmap is None:
+            return entry
+        # Loaded indexes store (offset, line count) until the file is queried.
+        offset, count = entry
+        linebytes = count * array.array('l').itemsize
+        lines = array.array('l')
+        lines.fromstring(self._mmap[offset:offset + linebytes])
+        bitmaps = self._mmap[offset + linebytes:
+            offset + linebytes + count * self._width]
+        return lines, bitmaps
+
+    def files(self):
+        return self._files.keys()
+
+    def tests_for_line(self, filename, line):
+        '''Returns the names of the tests that execute the line.'''
+        block = self._block(filename)
+        if block is None:
+            return []
+        lines, bitmaps = block
+        i = bisect.bisect_left(lines, line)
+        if i == len(lines) or lines[i] != line:
+            return []
+        return _tests_from_int(self.tests, _unpack_bitmap(
+            bitmaps[i * self._width:(i + 1) * self._width]))
+
+    def tests_for_lines(self, filename, first=None, last=None):
+        '''Returns the names of the tests that execute any line of the file
+        between first and last inclusive (the whole file by default).'''
+        block = self._block(filename)
+        if block is None:
+            return []
+        lines, bitmaps = block
+        start = 0 if first is None else bisect.bisect_left(lines, first)
+        end = len(lines) if last is None else bisect.bisect_right(lines, last)
+        combined = 0
+        for i in xrange(start, end):
+            combined |= _unpack_bitmap(
+                bitmaps[i * self._width:(i + 1) * self._width])
+        return _tests_from_int(self.tests, combined)
+
+    def save(self, filename):
+        '''Writes the index to a file that can be opened with load().'''
+        table = {}
+        offset = 0
+        for name in sorted(self._files):
+            lines, bitmaps = self._block(name)
+            table[name] = (offset, len(lines))
+            offset += len(lines) * lines.itemsize + len(bitmaps)
+        # Offsets in the table are relative to the end of the header.
+        header = marshal.dumps((self.tests, table))
+        with open(filename, 'wb') as fd:
+            fd.write(MAGIC)
+            fd.write(struct.pack('=II', VERSION, len(header)))
+            fd.write(header)
+            for name in sorted(self._files):
+                lines, bitmaps = self._block(name)
+                lines.tofile(fd)
+                fd.write(bitmaps)
+
+    @classmethod
+    def load(cls, filename):
+        '''Opens an index written by save(). The data of each file is only read
+        when the file is queried.'''
+        with open(filename, 'rb') as fd:
+            if fd.read(4) != MAGIC:
+                raise Exception("%s is not a test index" % filename)
+            version, length = struct.unpack('=II',
+                fd.read(struct.calcsize('=II')))
+            if version != VERSION:
+                raise Exception("Unsupported test index version %d" % version)
+            tests, table = marshal.loads(fd.read(length))
+            base = fd.tell()
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        index = cls(tests, dict((name, (base + offset, count))
+            for name, (offset, count) in table.iteritems()))
+        index._mmap = data
+        return index
+
+def _pack_bitmap(value, width):
+    return ''.join(chr((value >> (8 * i)) & 0xff) for i in xrange(width))
+
+def _unpack_bitmap(bitmap):
+    value = 0
+    for i, byte in enumerate(bitmap):
+        value |= ord(byte) << (8 * i)
+    return value
+
+def _tests_from_int(tests, value):
+    return [tests[i] for i in xrange(len(tests)) if value & (1 << i)]
+
+_lineRangeRe = re.compile(r'^(\d+)(?:-(\d+))?$')
+
+def _parse_location(location):
+    # FILE, FILE:LINE or FILE:FIRST-LAST
+    filename, _, lines = location.rpartition(':')
+    match = _lineRangeRe.match(lines)
+    if not filename or match is None:
+        return location, None, None
+    first, last = match.groups()
+    return filename, int(first), int(last or first)
+
+def main(argv):
+    from optparse import OptionParser
+    if not argv or argv[0] not in ('build', 'query'):
+        print >> sys.stderr, __doc__.split('Usage:')[1].strip('\n')
+        sys.exit(1)
+    command, argv = argv[0], argv[1:]
+    if command == 'build':
+        o = OptionParser(usage="%prog build -o INDEX LCOVFILE...")
+        o.add_option('-o', '--output', dest="outfile",
+            help="File to write the index to", metavar="FILE")
+        (opts, args) = o.parse_args(argv)
+        if opts.outfile is None:
+            o.error("Need to pass in -o!")
+        coverage = CoverageData()
+        for lcovFile in args:
+            print >> sys.stderr, "Reading file %s" % lcovFile
+            coverage.addFromLcovFile(open(lcovFile, 'r'))
+        TestIndex.build(coverage).save(opts.outfile)
+    else:
+        o = OptionParser(usage="%prog query INDEX FILE[:LINE[-LINE]]...")
+        (opts, args) = o.parse_args(argv)
+        if len(args) < 2:
+            o.error("Need an index and at least one location")
+        index = TestIndex.load(args[0])
+        for location in args[1:]:
+            filename, first, last = _parse_location(location)
+            if first is not None and first == last:
+                tests = index.tests_for_line(filename, first)
+            else:
+                tests = index.tests_for_lines(filename, first, last)
+            print '%s: %s' % (location, ' '.join(t or "''" for t in tests))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,16 +1,4 @@
-function displayDirectoryResults(json) {
-  // Fix up the top-level path issue.
-  if (path.length == 1 && path[0] === "")
-    path = [];
-
-  var root = json;
-  for (var i = 0; i < path.length; i++) {
-    var sub = root.files.filter(function (d) { return d.name == path[i] });
-    if (sub.length != 1)
-      throw new Error("Can't find " + path[i] + " in data!");
-    root = sub[0];
-  }
-
+function displayDirectoryResults(root) {
   var rows = root.files;
   rows.sort(function (a, b) { return d3.ascending(a.name, b.name); });
 
@@ -28,6 +16,27 @@ function displayDirectoryResults(json) {
     .attr("class", function (d) { return d._style; });
 }
 
+function shardDirectory(shard, test) {
+  // The directory is node 0 of its treemap shard, and its entries are the
+  // nodes whose parent is 0. Tests without coverage in the directory have no
+  // hits in the shard.
+  var hits = shard.hits[test];
+  function node(i) {
+    return {name: shard.names[i],
+            lines: shard.lines[i], "lines-hit": hits ? hits[0][i] : 0,
+            funcs: shard.funcs[i], "funcs-hit": hits ? hits[1][i] : 0,
+            branches: shard.branches[i],
+            "branches-hit": hits ? hits[2][i] : 0};
+  }
+  var root = node(0);
+  root.files = [];
+  for (var i = 1; i < shard.names.length; i++) {
+    if (shard.parents[i] == 0)
+      root.files.push(node(i));
+  }
+  return root;
+}
+
 function rowConv(d) {
   function array(hit, total) {
     if (total == 0)
@@ -44,8 +53,21 @@ function rowConv(d) {
 }
 
 function onDirectoryLoad() {
+  // The totals of every test come from the directory's treemap shard, which
+  // is loaded the first time another test is selected.
+  var shard = null;
   d3.select("#testsuite").on("change", function () {
-    d3.json(depth + "/" + this.value + ".json", displayDirectoryResults);
+    var test = this.value;
+    if (shard) {
+      displayDirectoryResults(shardDirectory(shard, test));
+      return;
+    }
+    d3.json("treemap.json", function (error, json) {
+      if (error)
+        throw error;
+      shard = json;
+      displayDirectoryResults(shardDirectory(shard, test));
+    });
   });
 }
 
@@ -90,8 +112,151 @@ function formatBranchData(bdata) {
   return entries.join("");
 }
 
+function emptyFileData(all) {
+  // Tests that never touched the file have no entry in data; present them as
+  // every line and branch having a zero count.
+  return {
+    lines: all.lines,
+    lcounts: all.lines.map(function () { return 0; }),
+    bcounts: all.bcounts.map(function (bdata) {
+      var zeroed = {};
+      for (var branch in bdata)
+        zeroed[branch] = bdata[branch].map(function () { return 0; });
+      return zeroed;
+    })
+  };
+}
+
+function testFileData(data, test) {
+  // Tests with the same coverage as 'all' or as another test hold the name of
+  // that entry instead of a copy of it.
+  var tdata = data[test];
+  if (typeof tdata == "string")
+    tdata = data[tdata];
+  return tdata || emptyFileData(data.all);
+}
+
 function onFileLoad() {
+  if (typeof chunkIndex != "undefined") {
+    loadChunkedFile(chunkIndex);
+    return;
+  }
+  d3.select("#testsuite").on("change", function () {
+    convertFileTable(testFileData(data, this.value));
+  });
+}
+
+// Pages of long files come with an index of the chunks of lines the file is
+// split into instead of the rows. Each chunk is a tbody of its own, which is
+// only filled in while it is near the visible part of the page and is
+// otherwise a single row of about the same height.
+var chunkedFile = null;
+
+function loadChunkedFile(index) {
+  chunkedFile = {index: index, test: "all", rowHeight: 16, chunks: [],
+                 updatePending: false};
+  var table = d3.select("#filetable");
+  table.select("tbody").remove();
+  for (var i = 0; i < index.chunks.length; i++) {
+    var first = i * index.size + 1;
+    var chunk = {index: i, first: first,
+                 last: Math.min(index.lines, first + index.size - 1),
+                 data: null, wanted: false, drawn: false, height: null,
+                 body: table.append("tbody")};
+    chunkedFile.chunks.push(chunk);
+    drawPlaceholder(chunk);
+  }
   d3.select("#testsuite").on("change", function () {
-    convertFileTable(data[this.value]);
+    chunkedFile.test = this.value;
+    chunkedFile.chunks.forEach(function (chunk) {
+      if (chunk.drawn)
+        drawChunk(chunk);
+    });
+  });
+  window.addEventListener("scroll", scheduleChunkUpdate);
+  window.addEventListener("resize", scheduleChunkUpdate);
+  updateChunks();
+}
+
+function scheduleChunkUpdate() {
+  if (chunkedFile.updatePending)
+    return;
+  chunkedFile.updatePending = true;
+  window.requestAnimationFrame(updateChunks);
+}
+
+function updateChunks() {
+  chunkedFile.updatePending = false;
+  // Chunks within a screen of the visible area are drawn.
+  var margin = window.innerHeight;
+  chunkedFile.chunks.forEach(function (chunk) {
+    var rect = chunk.body.node().getBoundingClientRect();
+    var visible = rect.bottom > -margin &&
+                  rect.top < window.innerHeight + margin;
+    if (visible && !chunk.wanted) {
+      chunk.wanted = true;
+      if (chunk.data) {
+        drawChunk(chunk);
+        return;
+      }
+      d3.json(chunkedFile.index.path + "/" + chunk.index + ".json",
+        function (error, json) {
+          if (error)
+            return;
+          chunk.data = json;
+          if (chunk.wanted) {
+            drawChunk(chunk);
+            scheduleChunkUpdate();
+          }
+        });
+    } else if (!visible && chunk.wanted) {
+      chunk.wanted = false;
+      if (chunk.drawn) {
+        chunk.height = rect.height;
+        drawPlaceholder(chunk);
+      }
+    }
   });
 }
+
+function drawPlaceholder(chunk) {
+  var lines = chunk.last - chunk.first + 1;
+  var counts = chunkedFile.index.chunks[chunk.index];
+  chunk.body.html("");
+  chunk.body.append("tr").attr("class", "placeholder")
+    .append("td").attr("colspan", 4)
+    .style("height", (chunk.height || lines * chunkedFile.rowHeight) + "px")
+    .text("Lines " + chunk.first + "-" + chunk.last + ": " + counts[1] +
+          " / " + counts[0] + " lines hit");
+  chunk.drawn = false;
+}
+
+function drawChunk(chunk) {
+  var json = chunk.data;
+  var data = testFileData(json.data, chunkedFile.test);
+  var rows = json.source.map(function (text, i) {
+    return {line: json.first + i, text: text};
+  });
+  data.lines.forEach(function (line, i) {
+    var row = rows[line - json.first];
+    row.count = data.lcounts[i];
+    row.branches = formatBranchData(data.bcounts[i]);
+  });
+  chunk.body.html("");
+  var tr = chunk.body.selectAll("tr").data(rows).enter().append("tr")
+    .attr("class", function (d) {
+      return d.count === undefined ? null : d.count > 0 ? "highcov" : "lowcov";
+    });
+  tr.append("td").text(function (d) { return d.line; });
+  tr.append("td").html(function (d) { return d.branches || ""; });
+  tr.append("td").text(function (d) {
+    return d.count === undefined ? "" : d.count;
+  });
+  tr.append("td").text(function (d) { return d.text; });
+  chunk.drawn = true;
+  if (!chunk.height) {
+    // Placeholders for chunks not drawn yet are sized after this one.
+    chunkedFile.rowHeight = chunk.body.node().getBoundingClientRect().height /
+                            rows.length;
+  }
+}